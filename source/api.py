@@ -1,23 +1,49 @@
 import json
 import os
+import hashlib
+import time
+import asyncio
+import threading
 
 import requests
-import sseclient
+import requests.adapters
+from json.decoder import scanstring
 
 from inference import *
 
-def get_models(endpoint, key):
+POOL_SIZE = 8
+CONNECT_TIMEOUT = 5
+READ_TIMEOUT = 60
+TIMEOUT = (CONNECT_TIMEOUT, READ_TIMEOUT)
+READ_SIZE = 65536
+CATALOGUE_PATH = "catalogue.json"
+CATALOGUE_TTL = 6 * 60 * 60
+CATALOGUE_LOCK = threading.Lock()
+
+# where the known providers put the text, so only that string gets decoded
+CHOICE_TEXT = ['"choices":[{"text":', '"choices": [{"text": ']
+DELTA_TEXT = '"delta":{"type":"text_delta","text":'
+
+def make_session(pool_size=POOL_SIZE):
+    # kept alive between requests so a generation skips the tcp and tls handshakes
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def get_models(endpoint, key, session=requests):
     models = {}
 
     if "api.openai.com" in endpoint:
-        response = requests.get(endpoint + "v1/models", headers={"Authorization": f"Bearer {key}"})
+        response = session.get(endpoint + "v1/models", headers={"Authorization": f"Bearer {key}"}, timeout=TIMEOUT)
         response.raise_for_status()
         result = json.loads(response.text)
         for model in result["data"]:
             if "gpt-3.5-turbo-instruct" in model["id"] or model["id"] in {"davinci-002", "babbage-002"}:
                 models[model["id"]] = model["id"]
     elif "api.together.xyz" in endpoint:
-        response = requests.get(endpoint + "models/info?=", headers={"Authorization": f"Bearer {key}"})
+        response = session.get(endpoint + "models/info?=", headers={"Authorization": f"Bearer {key}"}, timeout=TIMEOUT)
         response.raise_for_status()
         result = json.loads(response.text)
         for model in result:
@@ -30,7 +56,7 @@ def get_models(endpoint, key):
         }
     else:
         headers = {"Authorization": f"Bearer {key}"} if key.strip() else {}
-        response = requests.get(endpoint + "v1/models", headers=headers)
+        response = session.get(endpoint + "v1/models", headers=headers, timeout=TIMEOUT)
         response.raise_for_status()
         result = json.loads(response.text)
         for model in result["data"]:
@@ -38,20 +64,20 @@ def get_models(endpoint, key):
     
     return models
 
-def get_stream(endpoint, key, parameters):
+def open_stream(endpoint, key, parameters, session=requests):
     if "api.openai.com" in endpoint:
         parameters["stream"] = True
         parameters["frequency_penalty"] = parameters["repeat_penalty"]
         del parameters["top_k"]
         del parameters["repeat_penalty"]
         headers = {"Authorization": f"Bearer {key}"}
-        response = requests.post(endpoint + "v1/completions", json=parameters, headers=headers, stream=True)
+        response = session.post(endpoint + "v1/completions", json=parameters, headers=headers, stream=True, timeout=TIMEOUT)
     elif "api.together.xyz" in endpoint:
         parameters["stream_tokens"] = True
         parameters["repetition_penalty"] = parameters["repeat_penalty"]
         del parameters["repeat_penalty"]
         headers = {"Authorization": f"Bearer {key}"}
-        response = requests.post(endpoint + "v1/completions", json=parameters, headers=headers, stream=True)
+        response = session.post(endpoint + "v1/completions", json=parameters, headers=headers, stream=True, timeout=TIMEOUT)
     elif "api.anthropic.com" in endpoint:
         headers = {"x-api-key": f"{key}", "content-type" : "application/json", "anthropic-version": "2023-06-01"}
 
@@ -93,40 +119,158 @@ def get_stream(endpoint, key, parameters):
             "messages": messages
         }
 
-        response = requests.post(endpoint + "v1/messages", json=parameters, headers=headers, stream=True)
+        response = session.post(endpoint + "v1/messages", json=parameters, headers=headers, stream=True, timeout=TIMEOUT)
     else:
         parameters["stream"] = True
         parameters["frequency_penalty"] = parameters["repeat_penalty"]
         del parameters["top_k"]
         del parameters["repeat_penalty"]
         headers = {"Authorization": f"Bearer {key}"} if key.strip() else {}
-        response = requests.post(endpoint + "v1/completions", json=parameters, headers=headers, stream=True)   
+        response = session.post(endpoint + "v1/completions", json=parameters, headers=headers, stream=True, timeout=TIMEOUT)   
     
-    response.raise_for_status()
-    
-    client = sseclient.SSEClient(response)
-    for event in client.events():
-        if event.data == "[DONE]":
-            break
-        data = json.loads(event.data)
-
-        if "choices" in data:
-            yield data["choices"][0]["text"]
-
-        if "type" in data:
-            if data["type"] == "message_stop":
+    try:
+        response.raise_for_status()
+    except Exception:
+        response.close()
+        raise
+    return response
+
+def iter_chunks(response):
+    # whatever has arrived rather than a fixed size, so a short event is not held back,
+    # decoded since requests asks for gzip and leaves raw reads compressed
+    raw = response.raw
+    if not hasattr(raw, "read1"):
+        yield from response.iter_content(None)
+        return
+    while True:
+        chunk = raw.read1(READ_SIZE, decode_content=True)
+        if not chunk:
+            return
+        yield chunk
+
+def iter_events(chunks):
+    # the data of each event, other fields and comments are skipped
+    buffer = b""
+    data = []
+    for chunk in chunks:
+        lines = (buffer + chunk).split(b"\n")
+        buffer = lines.pop()
+        for line in lines:
+            if line[-1:] == b"\r":
+                line = line[:-1]
+            if not line:
+                if data:
+                    yield b"\n".join(data).decode("utf-8")
+                    data = []
+            elif line[:5] == b"data:":
+                data += [line[6:] if line[5:6] == b" " else line[5:]]
+    if data:
+        yield b"\n".join(data).decode("utf-8")
+
+def get_string(data, i):
+    if data[i:i+1] == " ":
+        i += 1
+    if data[i:i+1] != '"':
+        return None
+    try:
+        return scanstring(data, i + 1)[0]
+    except ValueError:
+        return None
+
+def get_text(data):
+    # returns the text an event carries, or None, and whether the stream has finished
+    if data == "[DONE]":
+        return None, True
+
+    for marker in CHOICE_TEXT:
+        i = data.find(marker)
+        if i >= 0:
+            text = get_string(data, i + len(marker))
+            if text != None:
+                return text, False
+    if data.startswith('{"type":"content_block_delta"'):
+        i = data.find(DELTA_TEXT)
+        if i >= 0:
+            text = get_string(data, i + len(DELTA_TEXT))
+            if text != None:
+                return text, False
+    if data.startswith('{"type":"message_stop"'):
+        return None, True
+
+    data = json.loads(data)
+    if "choices" in data:
+        return data["choices"][0]["text"], False
+    if "type" in data:
+        if data["type"] == "message_stop":
+            return None, True
+        if data["type"] == "content_block_delta":
+            return data["delta"]["text"], False
+    return None, False
+
+def read_stream(response):
+    # closing hands a finished connection back to the pool, an unfinished one is dropped
+    with response:
+        for data in iter_events(iter_chunks(response)):
+            text, finished = get_text(data)
+            if finished:
                 break
-            if data["type"] == "content_block_delta":
-                yield data["delta"]["text"]
+            if text != None:
+                yield text
     return
 
+def get_stream(endpoint, key, parameters, session=requests):
+    yield from read_stream(open_stream(endpoint, key, parameters, session))
+
+def catalogue_key(endpoint, key):
+    # lists differ between accounts, and a changed key must not reuse another's
+    return endpoint + " " + hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+class Catalogue():
+    # model lists per endpoint and key, kept next to config.json so connecting skips the download
+    def __init__(self, path=CATALOGUE_PATH, ttl=CATALOGUE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self.entries = {}
+        self.readEntries()
+
+    def readEntries(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self.entries = json.load(f)
+        except Exception:
+            pass
+
+    def get(self, endpoint, key):
+        with CATALOGUE_LOCK:
+            self.readEntries()
+            entry = self.entries.get(catalogue_key(endpoint, key))
+        if not entry or time.time() - entry["time"] >= self.ttl:
+            return None
+        return entry["models"]
+
+    def put(self, endpoint, key, models):
+        # merged into what is on disk, every API has its own Catalogue over the same file
+        with CATALOGUE_LOCK:
+            self.readEntries()
+            self.entries[catalogue_key(endpoint, key)] = {"time": time.time(), "models": models}
+            try:
+                tmp = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(tmp, "w", encoding="utf-8") as f:
+                    json.dump(self.entries, f, indent=4)
+                os.replace(tmp, self.path)
+            except Exception:
+                return
+
 class API():
-    def __init__(self, endpoint, key, response):
+    def __init__(self, endpoint, key, response, catalogue=None):
         self.abort = False
         self.endpoint = endpoint
         self.key = key
         self.model = None
+        self.models = None
         self.callback = response
+        self.session = make_session()
+        self.catalogue = catalogue or Catalogue()
 
     def respond(self, response):
         self.callback(response)
@@ -146,6 +290,7 @@ class API():
 
     def stop(self):
         self.abort = True
+        self.session.close()
         
     def getHeaders(self):
         return {
@@ -154,9 +299,31 @@ class API():
             "Authorization": f"Bearer {self.key}",
         }
 
+    def fetch(self):
+        models = get_models(self.endpoint, self.key, self.session)
+        self.catalogue.put(self.endpoint, self.key, models)
+        return models
+
+    def refresh(self):
+        try:
+            models = self.fetch()
+        except Exception as e:
+            self.setError(str(e))
+            return
+        if models != self.models:
+            self.models = models
+            self.respond({"type":"options", "data": {"models": list(models.values())}})
+
     def check(self):
+        models = self.catalogue.get(self.endpoint, self.key)
+        if models != None:
+            # answer from the cache straight away, the refresh behind it also checks the key still works
+            self.models = models
+            threading.Thread(target=self.refresh, daemon=True).start()
+            return
+
         try:
-            response = requests.get(self.endpoint, headers=self.getHeaders())
+            response = self.session.get(self.endpoint, headers=self.getHeaders(), timeout=TIMEOUT)
         except requests.exceptions.ConnectTimeout:
             raise Exception(f"Connection timed out")
         except requests.exceptions.ConnectionError:
@@ -165,7 +332,7 @@ class API():
             raise Exception(f"Connection failed")
         
         try:
-            get_models(self.endpoint, self.key)
+            self.models = self.fetch()
         except requests.HTTPError as e:
             raise Exception(e)
         except Exception as e:
@@ -178,70 +345,18 @@ class API():
             typ = req["type"]
 
             if typ == "options":
-                self.models = get_models(self.endpoint, self.key)                
+                if self.models == None:
+                    self.models = self.fetch()
                 names = [v for _,v in self.models.items()]
                 self.respond({"type":"options", "data": {"models": names}})
 
             if typ == "generate":
                 self.setStatus("generating")
-                
-                stop = req["data"]["stop_condition"]
-                del req["data"]["stop_condition"]
-
-                stop_context = ""
-                if stop == "Sentence":
-                    sentence, _ = split_sentences(req["data"]["prompt"])
-                    stop_context = sentence.lstrip()
+                parameters, stopper = self.prepare(req)
 
-                parameters = req["data"].copy()
-                parameters["model"] = [k for k,v in self.models.items() if v == parameters["model"]][0]
-
-                output = ""
                 errored = False
-                stopping = False
-
-                for next in get_stream(self.endpoint, self.key, parameters):
-                    if stop == "Sentence":
-                        tmp = stop_context + output + next
-
-                        sentence, sentences = split_sentences(tmp)
-                        sentences += [sentence]
-
-                        if len(sentences) > 1:
-                            sentence = sentences[0]
-                            next_tmp = sentence[len(stop_context + output):]
-                            output_tmp = sentence[len(stop_context):]
-                            if not output_tmp.strip():
-                                stop_context = ""
-                                output += next
-                            else:
-                                next = next_tmp
-                                output = output_tmp
-                                stopping = True
-                        else:
-                            output += next
-                    elif stop == "Paragraph":
-                        tmp = output + next
-                        match = PARAGRAPH_MATCH.search(output + next)
-                        if match:
-                            paragraph = tmp[:match.end()]
-                            next = paragraph[len(output):]
-                            output = paragraph
-                            stopping = True
-                        else:
-                            output += next
-                    elif stop == "Line":
-                        tmp = output + next
-                        match = LINE_MATCH.search(output + next)
-                        if match:
-                            paragraph = tmp[:match.end()]
-                            next = paragraph[len(output):]
-                            output = paragraph
-                            stopping = True
-                        else:
-                            output += next
-                    elif stop == "None":
-                        output += next
+                for next in get_stream(self.endpoint, self.key, parameters, self.session):
+                    next, stopping = stopper.feed(next)
 
                     self.respond({"type":"stream", "data": {"next": next}})
                     if stopping:
@@ -250,19 +365,7 @@ class API():
                     if self.abort:
                         errored = True
                         break
-                
-                rsp = {
-                    "type": "output",
-                    "data": {
-                        "parameters": req["data"].copy(),
-                        "model": {
-                            "model_path": self.model
-                        },
-                        "output": output,
-                        "errored": errored
-                    }
-                }
-                self.respond(rsp)
+                self.respond(self.getOutput(req, stopper.output, errored))
                 if not errored:
                     self.setDone()
                 else:
@@ -271,5 +374,108 @@ class API():
         except Exception as e:
             self.setError(str(e))
 
+    def prepare(self, req):
+        stop = req["data"]["stop_condition"]
+        del req["data"]["stop_condition"]
+
+        parameters = req["data"].copy()
+        parameters["model"] = [k for k,v in self.models.items() if v == parameters["model"]][0]
+        return parameters, StopCondition(stop, req["data"]["prompt"])
+
+    def getOutput(self, req, output, errored):
+        return {
+            "type": "output",
+            "data": {
+                "parameters": req["data"].copy(),
+                "model": {
+                    "model_path": self.model
+                },
+                "output": output,
+                "errored": errored
+            }
+        }
+
+def close_opened(future):
+    if not future.cancelled() and future.exception() == None:
+        future.result().close()
+
+class AsyncAPI(API):
+    # every generate is its own task, so a slow provider only holds up its own stream,
+    # requests with an "id" get it back on their responses and can be aborted alone
+    def __init__(self, endpoint, key, response, catalogue=None, streams=POOL_SIZE):
+        super().__init__(endpoint, key, response, catalogue)
+        self.tasks = {}
+        self.serials = set()
+        self.limit = asyncio.Semaphore(streams)
+        self.lock = asyncio.Lock()
+
+    def submit(self, request):
+        typ = request["type"]
+        id = request.get("id")
+
+        if typ == "abort":
+            self.cancel(id)
+            return
+        if typ == "generate":
+            task = asyncio.create_task(self.generate(request, id))
+            self.tasks[task] = id
+            task.add_done_callback(self.tasks.pop)
+        else:
+            task = asyncio.create_task(self.serial(request))
+            self.serials.add(task)
+            task.add_done_callback(self.serials.discard)
+
+    def cancel(self, id=None):
+        for task, i in list(self.tasks.items()):
+            if id == None or i == id:
+                task.cancel()
+
+    async def join(self):
+        await asyncio.gather(*self.tasks, *self.serials, return_exceptions=True)
+
+    async def serial(self, request):
+        # everything but generate keeps its order, and runs off the loop
+        async with self.lock:
+            await asyncio.to_thread(self.process, request)
+
+    async def generate(self, req, id):
+        def respond(response):
+            if id != None:
+                response["id"] = id
+            self.respond(response)
+
+        respond({"type": "status", "data": {"message": "generating"}})
+        opening = None
+        response = None
+        errored = False
+        try:
+            parameters, stopper = self.prepare(req)
+            async with self.limit:
+                # shielded, so a cancel during connect still gets the response back to close
+                opening = asyncio.ensure_future(asyncio.to_thread(open_stream, self.endpoint, self.key, parameters, self.session))
+                response = await asyncio.shield(opening)
+                events = read_stream(response)
+                while True:
+                    chunk = await asyncio.to_thread(next, events, None)
+                    if chunk == None:
+                        break
+                    chunk, stopping = stopper.feed(chunk)
+                    respond({"type": "stream", "data": {"next": chunk}})
+                    if stopping:
+                        break
+        except asyncio.CancelledError:
+            errored = True
+        except Exception as e:
+            respond({"type": "error", "data": {"message": str(e)}})
+            return
+        finally:
+            if response != None:
+                response.close()
+            elif opening != None:
+                opening.add_done_callback(close_opened)
+
+        respond(self.getOutput(req, stopper.output, errored))
+        respond({"type": "aborted"} if errored else {"type": "done"})
+
             
 #https://api.together.xyz/inference
\ No newline at end of file
@@ -4,14 +4,59 @@ import queue
 import threading
 import time
 import copy
+import asyncio
 import argparse
 
-from PyQt5.QtCore import pyqtSlot, pyqtSignal, QThread
+from PyQt5.QtCore import pyqtSlot, pyqtSignal, QThread, QObject, QTimer
 from PyQt5.QtWidgets import QApplication
 
 import inference
 
 MODELS_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "models")
+STREAM_INTERVAL = 16
+FIRST_TOKEN_TIMEOUT = 30
+STREAM_TIMEOUT = 10
+FAILURE_COOLDOWN = 60
+TTFT_WEIGHT = 0.3
+
+class StreamCoalescer(QObject):
+    response = pyqtSignal(object)
+    def __init__(self, parent, interval=STREAM_INTERVAL):
+        super().__init__(parent)
+        self.pending = []
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.setInterval(interval)
+        self.timer.timeout.connect(self.flush)
+
+    def setInterval(self, interval):
+        self.timer.setInterval(interval)
+
+    @pyqtSlot(object)
+    def onResponse(self, response):
+        if response["type"] == "stream":
+            self.pending += [response["data"]["next"]]
+            if not self.timer.isActive():
+                self.flush()
+            return
+
+        # anything else ends the batch, keep the stream ahead of it
+        self.flush()
+        self.timer.stop()
+        self.response.emit(response)
+
+    @pyqtSlot()
+    def flush(self):
+        if not self.pending:
+            return
+        next = "".join(self.pending)
+        self.pending = []
+        self.timer.start()
+        self.response.emit({"type": "stream", "data": {"next": next}})
+
+    def reset(self):
+        self.timer.stop()
+        self.pending = []
 
 class CoreBackend(QThread):
     response = pyqtSignal(object)
@@ -19,7 +64,7 @@ class CoreBackend(QThread):
         super().__init__(gui)
         self.gui = gui
         self.stopping = False
-        self.requests = []
+        self.requests = queue.Queue()
         self.inference = inference
 
     def hello(self):
@@ -29,24 +74,25 @@ class CoreBackend(QThread):
         self.hello()
 
         while not self.stopping:
-            QApplication.processEvents()
-            if self.requests:
-                request = self.requests.pop(0)
-                self.inference.process(request)
-            else:
-                QThread.msleep(10)
+            request = self.requests.get()
+            if request == None:
+                break
+            self.inference.process(request)
 
     @pyqtSlot()
     def stop(self):
         self.inference.stop()
         self.stopping = True
+        self.requests.put(None)
 
     @pyqtSlot()
     def makeRequest(self, request):
         if request["type"] == "abort":
+            # handled out of band, the inference checks the flag while streaming
             self.inference.abort = True
+            return
         request = copy.deepcopy(request)
-        self.requests += [request]
+        self.requests.put(request)
 
     @pyqtSlot()
     def makeResponse(self, response):
@@ -60,7 +106,28 @@ class LocalBackend(CoreBackend):
 import api
 class APIBackend(CoreBackend):
     def __init__(self, gui, endpoint, key):
-        super().__init__(api.API(endpoint, key, self.makeResponse), gui)
+        super().__init__(api.AsyncAPI(endpoint, key, self.makeResponse), gui)
+
+    def run(self):
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        await asyncio.to_thread(self.hello)
+
+        while not self.stopping:
+            request = await asyncio.to_thread(self.requests.get)
+            if request == None:
+                break
+            self.inference.submit(request)
+
+        self.inference.cancel()
+        await self.inference.join()
+
+    @pyqtSlot()
+    def makeRequest(self, request):
+        # aborts go through the loop as well, they cancel the stream they name or every stream
+        request = copy.deepcopy(request)
+        self.requests.put(request)
 
     def hello(self):
         self.makeResponse({"type": "status", "data": {"message": "connecting"}})
@@ -89,6 +156,17 @@ class RemoteBackend(QThread):
         self.client = None
 
         self.scheme = None
+        self.hello = None
+        self.features = set()
+        self.method = None
+        self.mirrors = {}
+        self.resync = None
+        self.resuming = False
+
+        # survives reconnects, lets the server hand back a running generation
+        self.session = secrets.token_hex(16)
+        self.generating = False
+        self.received = 0
         if not key:
             key = DEFAULT_KEY
         self.key = key
@@ -113,26 +191,82 @@ class RemoteBackend(QThread):
             return
         if self.client:
             self.makeResponse({"type": "status", "data": {"message": "connected"}})
-            self.requests += [{"type":"options"}]
+            self.startSession()
 
-    def run(self):
+    def startSession(self, resume=False):
+        # older servers ignore the hello, their first reply is the options instead
         self.scheme = get_scheme(self.key)
+        self.features = set()
+        self.method = None
+        self.mirrors = {}
+        self.resync = None
+        self.hello = make_hello(FEATURES)
+        self.hello["data"]["session"] = self.session
+        self.hello["data"]["resume"] = self.received if resume and self.generating else None
+        self.resuming = resume
+        self.requests = [self.hello] + ([] if resume else [{"type":"options"}]) + self.requests
+
+    def reconnect(self):
+        if self.stopping or "resume" not in self.features:
+            return False
+
+        self.client = None
+        self.makeResponse({"type": "status", "data": {"message": "connecting"}})
+        deadline = time.time() + RESUME_GRACE
+        while not self.client and not self.stopping and time.time() < deadline:
+            try:
+                self.client = websockets.sync.client.connect(self.endpoint, open_timeout=2, max_size=None)
+            except Exception:
+                QThread.msleep(500)
+
+        if not self.client or self.stopping:
+            return False
+        self.makeResponse({"type": "status", "data": {"message": "connected"}})
+        self.startSession(True)
+        return True
+
+    def onHello(self, response):
+        hello, self.hello = self.hello, None
+        resumed = response["type"] == "hello" and response["data"].get("resumed", False)
+        if self.resuming and not resumed:
+            # the server lost our client, so whatever was running and the model went with it
+            if self.generating:
+                self.makeResponse({"type": "error", "data": {"message": "connection closed"}})
+            self.makeResponse({"type": "status", "data": {"message": "unloading"}})
+            self.makeResponse({"type": "done"})
+            self.requests.insert(0, {"type": "options"})
+        self.resuming = False
+
+        if response["type"] != "hello":
+            return False
+        self.scheme = get_session_scheme(self.key, hello["data"]["nonce"], bytes(response["data"]["nonce"]))
+        self.features = set(response["data"]["features"])
+        self.method = get_compression(self.features)
+        return True
+
+    def run(self):
         self.connect()
         while self.client and not self.stopping:
             try:
                 while True:
                     try:
                         data = self.client.recv(0)
-                        response = decrypt(self.scheme, data)
-                        self.makeResponse(response)
+                        response = decrypt(self.scheme, data, self.method)
+                        if self.hello and self.onHello(response):
+                            continue
+                        responses = response["data"]["responses"] if response["type"] == "frame" else [response]
+                        for r in responses:
+                            if r["type"] == "resync":
+                                self.onResync()
+                            else:
+                                self.makeResponse(r)
                         QApplication.processEvents()
                     except TimeoutError:
                         break
                 
                 if self.requests:
                     request = self.requests.pop(0)
-                    data = encrypt(self.scheme, request)
-                    data = [data[i:min(i+FRAGMENT_SIZE,len(data))] for i in range(0, len(data), FRAGMENT_SIZE)]
+                    data = fragment(encrypt(self.scheme, self.shrinkRequest(request), self.method))
 
                     self.client.send(data)
                     QApplication.processEvents()
@@ -140,6 +274,8 @@ class RemoteBackend(QThread):
                     QThread.msleep(5)
 
             except websockets.exceptions.ConnectionClosed:
+                if self.reconnect():
+                    continue
                 self.makeResponse({"type": "error", "data": {"message": "connection closed"}})
                 break
             except Exception as e:
@@ -155,6 +291,42 @@ class RemoteBackend(QThread):
             self.client.close()
             self.client = None
 
+    def onResync(self):
+        # the server lost the mirror, send the whole prompt again
+        if self.resync:
+            self.mirrors.pop(self.resync["data"]["mirror"], None)
+            self.requests.insert(0, self.resync)
+            self.resync = None
+
+    def shrinkRequest(self, request):
+        if request["type"] != "generate" or "deltas" not in self.features or "mirror" in request["data"]:
+            return request
+
+        # consecutive prompts from a tab differ by a few words, send an edit against its mirror
+        prompt = request["data"]["prompt"]
+        full = copy.deepcopy(request)
+        best, delta = None, None
+        for mirror, (text, _) in self.mirrors.items():
+            d = make_delta(text, prompt)
+            if not delta or len(d["text"]) < len(delta["text"]):
+                best, delta = mirror, d
+
+        if delta and len(delta["text"]) < len(prompt) // 2:
+            mirror = best
+            request = copy.deepcopy(request)
+            del request["data"]["prompt"]
+            request["data"]["delta"] = delta
+            self.resync = full
+        else:
+            unused = [i for i in range(MIRROR_COUNT) if i not in self.mirrors]
+            mirror = unused[0] if unused else min(self.mirrors, key=lambda i: self.mirrors[i][1])
+            request = full
+
+        request["data"]["mirror"] = mirror
+        full["data"]["mirror"] = mirror
+        self.mirrors[mirror] = (prompt, time.time())
+        return request
+
     @pyqtSlot()
     def stop(self):
         self.stopping = True
@@ -167,6 +339,297 @@ class RemoteBackend(QThread):
         request = copy.deepcopy(request)
         self.requests += [request]
 
+    def track(self, response):
+        typ = response["type"]
+        if typ == "status" and response["data"]["message"] == "generating":
+            self.generating, self.received = True, 0
+        elif typ == "stream":
+            self.received += len(response["data"]["next"])
+        elif typ in {"done", "aborted", "error"}:
+            self.generating = False
+
     @pyqtSlot()
     def makeResponse(self, response):
-        self.response.emit(response)
\ No newline at end of file
+        self.track(response)
+        self.response.emit(response)
+
+class RouterTarget():
+    def __init__(self, index, name, backend):
+        self.index = index
+        self.name = name
+        self.backend = backend
+        self.api = type(backend) == APIBackend
+        self.status = "connected" if type(backend) == LocalBackend else "disconnected"
+        self.state = "idle"
+        self.models = []
+        self.loaded = None
+        self.ttft = None
+        self.failed = 0
+
+    def healthy(self):
+        return self.status == "connected" and time.time() - self.failed > FAILURE_COOLDOWN
+
+    def ready(self, model):
+        if self.api:
+            return model in self.models
+        return self.loaded == model
+
+class RouterBackend(QObject):
+    # an ordered set of backends behind one, each generate goes to the quickest idle one
+    # and moves on to the next, from where it left off, when it errors or stalls
+    response = pyqtSignal(object)
+    relay = pyqtSignal(int, object)
+    def __init__(self, gui, targets, timeout=FIRST_TOKEN_TIMEOUT):
+        super().__init__(gui)
+        self.gui = gui
+        self.timeout = timeout
+        self.targets = []
+        for endpoint, key in targets:
+            if endpoint.lower() == "local":
+                name, backend = "Local", LocalBackend(gui)
+            elif endpoint.startswith("ws"):
+                name, backend = endpoint, RemoteBackend(gui, endpoint, key)
+            else:
+                name, backend = endpoint, APIBackend(gui, endpoint, key)
+            target = RouterTarget(len(self.targets), name, backend)
+            # re-emitted so the responses arrive on this thread
+            backend.response.connect(lambda response, i=target.index: self.relay.emit(i, response))
+            self.targets += [target]
+        self.relay.connect(self.onResponse)
+
+        self.status = None
+        self.model = None
+        self.loading = False
+        self.request = None
+        self.active = None
+        self.prefix = ""
+        self.text = ""
+        self.tried = set()
+        self.started = 0
+        self.first = None
+
+        self.timer = QTimer(self)
+        self.timer.setSingleShot(True)
+        self.timer.timeout.connect(self.onTimeout)
+
+    def start(self):
+        for target in self.targets:
+            target.backend.start()
+        self.updateStatus()
+
+    def stop(self):
+        self.timer.stop()
+        for target in self.targets:
+            target.backend.stop()
+
+    def wait(self, msecs):
+        return all([target.backend.wait(msecs) for target in self.targets])
+
+    def terminate(self):
+        for target in self.targets:
+            if target.backend.isRunning():
+                target.backend.terminate()
+
+    def emitStatus(self, message):
+        self.response.emit({"type": "status", "data": {"message": message}})
+
+    def updateStatus(self):
+        statuses = [t.status for t in self.targets]
+        status = "disconnected"
+        if "connected" in statuses:
+            status = "connected"
+        elif "connecting" in statuses:
+            status = "connecting"
+        if status != self.status:
+            self.status = status
+            self.emitStatus(status)
+
+    def getOptions(self):
+        models = []
+        for target in self.targets:
+            models += [m for m in target.models if not m in models]
+        return models
+
+    @pyqtSlot()
+    def makeRequest(self, request):
+        request = copy.deepcopy(request)
+        typ = request["type"]
+
+        if typ == "options":
+            for target in self.targets:
+                target.backend.makeRequest(request)
+        if typ == "load":
+            self.load(request)
+        if typ == "unload":
+            self.unload()
+        if typ == "generate":
+            self.request = request
+            self.prefix = ""
+            self.text = ""
+            self.tried = set()
+            self.emitStatus("generating")
+            self.dispatch()
+        if typ == "abort":
+            self.timer.stop()
+            if self.active:
+                self.active.backend.makeRequest(request)
+            elif self.request:
+                self.request = None
+                self.response.emit({"type": "aborted"})
+
+    def load(self, request):
+        self.model = request["data"]["model_path"]
+        self.emitStatus("loading")
+
+        ready = False
+        for target in self.targets:
+            if not target.healthy() or not self.model in target.models:
+                continue
+            if target.api:
+                ready = True
+            elif target.loaded != self.model and target.state == "idle":
+                target.state = "loading"
+                target.backend.makeRequest(request)
+        self.loading = not ready and any(t.state == "loading" for t in self.targets)
+
+        if ready:
+            self.response.emit({"type": "done"})
+        elif not self.loading:
+            self.response.emit({"type": "error", "data": {"message": "no backend has this model"}})
+
+    def unload(self):
+        self.emitStatus("unloading")
+        for target in self.targets:
+            if target.loaded and target.state == "idle":
+                target.backend.makeRequest({"type": "unload"})
+                target.state = "unloading"
+            target.loaded = None
+        self.model = None
+        self.response.emit({"type": "done"})
+
+    def pick(self):
+        candidates = [
+            t for t in self.targets
+            if t.index not in self.tried and t.state == "idle" and t.healthy() and t.ready(self.model)
+        ]
+        if not candidates:
+            return None
+        # unmeasured targets go first so every one gets a measurement, then the quickest
+        return min(candidates, key=lambda t: (t.ttft or 0, t.index))
+
+    def dispatch(self):
+        target = self.pick()
+        if not target:
+            self.request = None
+            self.response.emit({"type": "error", "data": {"message": "no backend available"}})
+            return
+
+        request = copy.deepcopy(self.request)
+        data = request["data"]
+        # carry on from whatever the failed backend already streamed
+        data["prompt"] += self.prefix
+        if target.api:
+            data["model"] = self.model
+            data.pop("min_p", None)
+        elif data.get("min_p", 0.0) > 0.0:
+            data["top_p"] = 1.0
+            data["top_k"] = 0
+
+        self.active = target
+        self.tried.add(target.index)
+        target.state = "generating"
+        self.started = time.time()
+        self.first = None
+        target.backend.makeRequest(request)
+        self.timer.start(int(self.timeout * 1000))
+
+    def failover(self, target):
+        target.failed = time.time()
+        self.timer.stop()
+        self.active = None
+        self.prefix += self.text
+        self.text = ""
+        if self.request:
+            self.dispatch()
+
+    @pyqtSlot()
+    def onTimeout(self):
+        target = self.active
+        if not target:
+            return
+        print(f"ROUTER: {target.name} timed out")
+        target.backend.makeRequest({"type": "abort"})
+        self.failover(target)
+
+    @pyqtSlot(int, object)
+    def onResponse(self, index, response):
+        target = self.targets[index]
+        typ = response["type"]
+        active = target == self.active
+
+        if typ == "status":
+            message = response["data"]["message"]
+            if message in {"connected", "connecting", "disconnected"}:
+                target.status = message
+                self.updateStatus()
+                # a resuming backend says connecting and carries on, only a lost one fails over
+                if active and message == "connecting":
+                    self.timer.stop()
+                if active and message == "connected":
+                    self.timer.start(int((self.timeout if self.first == None else STREAM_TIMEOUT) * 1000))
+                if active and message == "disconnected":
+                    print(f"ROUTER: {target.name} lost its connection")
+                    self.failover(target)
+            elif message == "unloading" and target.state != "unloading":
+                # the backend dropped the model itself
+                target.loaded = None
+            return
+
+        if typ == "options":
+            target.models = response["data"]["models"]
+            self.response.emit({"type": "options", "data": {"models": self.getOptions()}})
+            return
+
+        if typ == "stream" and active:
+            self.timer.start(STREAM_TIMEOUT * 1000)
+            if self.first == None:
+                self.first = time.time()
+                ttft = self.first - self.started
+                target.ttft = ttft if target.ttft == None else (1 - TTFT_WEIGHT) * target.ttft + TTFT_WEIGHT * ttft
+            self.text += response["data"]["next"]
+            self.response.emit(response)
+            return
+
+        if typ == "output" and active:
+            response["data"]["output"] = self.prefix + response["data"]["output"]
+            response["data"]["backend"] = target.name
+            self.response.emit(response)
+            return
+
+        if typ in {"done", "aborted"}:
+            state, target.state = target.state, "idle"
+            if state == "loading":
+                target.loaded = self.model
+                if self.loading:
+                    self.loading = False
+                    self.response.emit({"type": "done"})
+            if active:
+                self.active = None
+                self.request = None
+                self.timer.stop()
+                self.response.emit(response)
+            return
+
+        if typ == "error":
+            state, target.state = target.state, "idle"
+            print(f"ROUTER: {target.name} errored, {response['data']['message']}")
+            if active:
+                self.failover(target)
+                return
+            target.failed = time.time()
+            if state == "loading" and self.loading and not any(t.state == "loading" for t in self.targets):
+                self.loading = False
+                self.response.emit(response)
+            elif not any(t.healthy() for t in self.targets):
+                self.response.emit(response)
+            return
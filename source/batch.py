@@ -0,0 +1,400 @@
+import os
+import glob
+import math
+import time
+import codecs
+import threading
+import collections
+
+import inference
+import metrics
+from inference import get_binding, log_traceback, StopCondition
+
+BATCH_SLOTS = 4
+BATCH_SIZE = 512
+REPEAT_LAST_N = 64
+STALL_WAIT = 0.01
+
+DEFAULT_SAMPLING = {
+    "temperature": 0.8,
+    "top_p": 0.95,
+    "top_k": 40,
+    "min_p": 0.05,
+    "repeat_penalty": 1.1
+}
+
+def sample(np, logits, parameters, history, rng):
+    # same order as llama.cpp: repeat penalty, top_k, top_p, min_p, temperature
+    logits = np.array(logits, dtype=np.float32)
+    p = {**DEFAULT_SAMPLING, **{k:v for k,v in parameters.items() if k in DEFAULT_SAMPLING and v != None}}
+
+    penalty = p["repeat_penalty"]
+    if penalty != 1.0 and history:
+        ids = np.unique(np.array(history[-REPEAT_LAST_N:], dtype=np.int64))
+        values = logits[ids]
+        logits[ids] = np.where(values > 0, values / penalty, values * penalty)
+
+    if p["temperature"] <= 0.0:
+        return int(np.argmax(logits))
+
+    n = len(logits)
+    k = n if p["top_k"] <= 0 else min(p["top_k"], n)
+    ids = np.argpartition(-logits, k - 1)[:k] if k < n else np.arange(n)
+    values = logits[ids]
+    top = float(values.max())
+    norm = float(np.exp(values - top).sum())
+
+    # min_p keeps a prefix of the sorted candidates, p/p_max only depends on
+    # the logit difference, so it can prune before the sort
+    if p["min_p"] > 0.0:
+        keep = values >= top + math.log(p["min_p"])
+        ids, values = ids[keep], values[keep]
+
+    order = np.argsort(-values, kind="stable")
+    ids, values = ids[order], values[order]
+
+    if p["top_p"] < 1.0:
+        cumulative = np.cumsum(np.exp(values - top) / norm)
+        last = int(np.searchsorted(cumulative, p["top_p"])) + 1
+        ids, values = ids[:last], values[:last]
+
+    values = (values - top) / p["temperature"]
+    probs = np.exp(values - values.max())
+    probs /= probs.sum()
+    return int(ids[rng.choice(len(ids), p=probs)])
+
+class Sequence():
+    def __init__(self, request, respond):
+        self.data = request["data"]
+        self.stop = self.data.pop("stop_condition", None)
+        self.respond = respond
+        self.abort = False
+        self.done = False
+
+        self.slot = None
+        self.tokens = []
+        self.pending = []
+        self.history = []
+        self.generated = 0
+        self.started = None
+        self.first = None
+        self.reused = 0
+        self.stopper = None
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        self.rng = None
+
+class Slot():
+    def __init__(self, id):
+        self.id = id
+        self.tokens = []
+        self.sequence = None
+
+class BatchInference():
+    # decodes every active sequence in one llama batch per step, each sequence
+    # owns a KV slot (seq_id) of n_ctx tokens within the shared context
+    batched = True
+
+    def __init__(self, models_path, response, slots=BATCH_SLOTS):
+        self.llm = None
+        self.model = None
+        self.models_path = models_path
+        self.callback = response
+        self.slots = [Slot(i) for i in range(max(slots, 1))]
+
+        self.n_ctx = 0
+        self.batch = None
+        self.waiting = collections.deque()
+        self.stopping = False
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def respond(self, response):
+        self.callback(response)
+
+    def setStatus(self, message):
+        self.respond({"type": "status", "data": {"message": message}})
+
+    def setDone(self):
+        self.respond({"type": "done"})
+
+    def setError(self, message):
+        self.respond({"type": "error", "data": {"message": message}})
+
+    def start(self):
+        module = get_binding().module
+        try:
+            self.batch = module.llama_batch_init(BATCH_SIZE, 0, len(self.slots))
+        except TypeError:
+            self.batch = module.llama_batch_init(BATCH_SIZE, 0)
+        self.stopping = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def shutdown(self, message):
+        with self.condition:
+            self.stopping = True
+            self.condition.notify_all()
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+        sequences = list(self.waiting) + [s.sequence for s in self.slots if s.sequence]
+        self.waiting.clear()
+        for sequence in sequences:
+            self.finish(sequence, message)
+        for slot in self.slots:
+            slot.tokens = []
+
+        if self.batch != None:
+            get_binding().module.llama_batch_free(self.batch)
+            self.batch = None
+
+    def process(self, request):
+        if request["type"] in {"load", "generate"} and get_binding().error:
+            self.setError("failed to load llama-cpp-python: " + get_binding().error)
+            return
+
+        try:
+            req = request
+            typ = req["type"]
+
+            if typ == "load":
+                self.setStatus("loading")
+                if self.llm:
+                    self.shutdown("model unloaded")
+                    self.llm._model.__del__()
+                    self.llm = None
+                try:
+                    self.model = req["data"].copy()
+                    model_path = req["data"]["model_path"]
+                    req["data"]["model_path"] = os.path.join(self.models_path, f"{model_path}.gguf")
+                    self.n_ctx = req["data"].get("n_ctx", 512)
+                    req["data"]["n_ctx"] = self.n_ctx * len(self.slots)
+                    req["data"]["n_batch"] = BATCH_SIZE
+                    start = time.perf_counter()
+                    self.llm = get_binding().Llama(verbose=False, **req["data"])
+                    metrics.MODEL_LOAD.observe(time.perf_counter() - start)
+                    self.start()
+                except Exception as e:
+                    self.llm = None
+                    log_traceback("INFERENCE")
+                    self.setError("failed to load model: " + str(e))
+                    return
+                self.setDone()
+                return
+            if typ == "unload":
+                self.setStatus("unloading")
+                if self.llm:
+                    self.shutdown("model unloaded")
+                    self.llm._model.__del__()
+                self.llm = None
+                self.setDone()
+                return
+            if typ == "options":
+                if not os.path.exists(self.models_path):
+                    self.setError("failed to locate model folder: " + self.models_path)
+                    return
+
+                models = glob.glob(os.path.join(self.models_path, "**", "*.gguf"), recursive=True)
+                models = [os.path.relpath(m, self.models_path).rsplit(".",1)[0] for m in models]
+                self.respond({"type":"options", "data": {"models": models}})
+                return
+            if typ == "generate":
+                self.generate(req, self.callback)
+                return
+        except Exception as e:
+            self.setError(str(e))
+
+    def generate(self, request, respond):
+        sequence = Sequence(request, respond)
+        if not self.llm:
+            sequence.done = True
+            respond({"type": "error", "data": {"message": "no model loaded"}})
+            return sequence
+
+        respond({"type": "status", "data": {"message": "generating"}})
+        with self.condition:
+            self.waiting.append(sequence)
+            self.condition.notify()
+        return sequence
+
+    def admit(self, sequence, slot, tokens):
+        import numpy
+
+        data = sequence.data
+
+        # keep whatever prefix of this slot's KV matches, the last token is redone for its logits
+        keep = 0
+        for a, b in zip(slot.tokens, tokens[:-1]):
+            if a != b:
+                break
+            keep += 1
+        get_binding().module.llama_kv_cache_seq_rm(self.llm.ctx, slot.id, keep, -1)
+
+        slot.tokens = slot.tokens[:keep]
+        slot.sequence = sequence
+        sequence.slot = slot
+        sequence.tokens = tokens
+        sequence.pending = tokens[keep:]
+        sequence.history = list(tokens[-REPEAT_LAST_N:])
+        sequence.reused = keep
+        sequence.started = time.perf_counter()
+        sequence.stopper = StopCondition(sequence.stop, data["prompt"])
+        seed = data.get("seed", None)
+        sequence.rng = numpy.random.default_rng(None if seed == None or seed < 0 else seed)
+
+    def schedule(self):
+        # new sequences only join between steps, into the free slot sharing the longest prefix
+        while self.waiting:
+            free = [s for s in self.slots if not s.sequence]
+            if not free:
+                break
+            sequence = self.waiting.popleft()
+            if sequence.abort:
+                self.finish(sequence, None)
+                continue
+            try:
+                data = sequence.data
+                tokens, data["prompt"] = inference.get_tokens(self.llm, data["prompt"], self.n_ctx - data["max_tokens"], self.n_ctx)
+                def common(slot):
+                    n = 0
+                    for a, b in zip(slot.tokens, tokens):
+                        if a != b:
+                            break
+                        n += 1
+                    return n
+                self.admit(sequence, max(free, key=common), tokens)
+            except Exception as e:
+                log_traceback("BATCH")
+                self.finish(sequence, str(e))
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.stopping and not self.waiting and not any(s.sequence for s in self.slots):
+                    self.condition.wait()
+                if self.stopping:
+                    return
+                self.schedule()
+
+            try:
+                if not self.step():
+                    # every active sequence is waiting on a stalled client
+                    with self.condition:
+                        self.condition.wait(STALL_WAIT)
+            except Exception as e:
+                log_traceback("BATCH")
+                for slot in self.slots:
+                    if slot.sequence:
+                        self.finish(slot.sequence, str(e))
+                    slot.tokens = []
+                get_binding().module.llama_kv_cache_clear(self.llm.ctx)
+
+    def step(self):
+        import numpy
+        module = get_binding().module
+
+        active = []
+        for slot in self.slots:
+            sequence = slot.sequence
+            if not sequence:
+                continue
+            if sequence.abort:
+                self.finish(sequence, None)
+                continue
+            if getattr(sequence.respond, "stalled", False):
+                continue
+            active += [sequence]
+
+        # sequences that are generating go first, prompts fill the rest of the batch
+        active.sort(key=lambda s: len(s.pending))
+        batch = self.batch
+        entries = []
+        n = 0
+        for sequence in active:
+            count = min(len(sequence.pending), BATCH_SIZE - n)
+            if count <= 0:
+                continue
+            slot = sequence.slot
+            chunk = sequence.pending[:count]
+            sequence.pending = sequence.pending[count:]
+            for j, token in enumerate(chunk):
+                batch.token[n] = token
+                batch.pos[n] = len(slot.tokens) + j
+                batch.n_seq_id[n] = 1
+                batch.seq_id[n][0] = slot.id
+                batch.logits[n] = False
+                n += 1
+            slot.tokens += chunk
+            if not sequence.pending:
+                batch.logits[n-1] = True
+                entries += [(sequence, n-1)]
+
+        if n == 0:
+            return False
+        batch.n_tokens = n
+
+        result = module.llama_decode(self.llm.ctx, batch)
+        if result != 0:
+            raise RuntimeError(f"llama_decode failed ({result})")
+
+        n_vocab = self.llm.n_vocab()
+        eos = self.llm.token_eos()
+        for sequence, index in entries:
+            logits = numpy.ctypeslib.as_array(module.llama_get_logits_ith(self.llm.ctx, index), shape=(n_vocab,))
+            token = sample(numpy, logits, sequence.data, sequence.history, sequence.rng)
+            self.advance(sequence, token, eos)
+        return True
+
+    def advance(self, sequence, token, eos):
+        if token == eos:
+            self.finish(sequence, None)
+            return
+
+        sequence.generated += 1
+        if sequence.first == None:
+            sequence.first = time.perf_counter()
+            metrics.PROMPT_EVAL.observe(sequence.first - sequence.started)
+        sequence.history = sequence.history[-REPEAT_LAST_N+1:] + [token]
+        text = sequence.decoder.decode(self.llm.detokenize([token]))
+
+        next, stopping = sequence.stopper.feed(text)
+        sequence.respond({"type":"stream", "data": {"next": next}})
+
+        if stopping or sequence.generated >= sequence.data["max_tokens"]:
+            self.finish(sequence, None)
+        elif sequence.slot and len(sequence.slot.tokens) >= self.n_ctx:
+            self.finish(sequence, None)
+        else:
+            sequence.pending = [token]
+
+    def finish(self, sequence, error):
+        if sequence.done:
+            return
+        sequence.done = True
+        if sequence.slot:
+            sequence.slot.sequence = None
+            sequence.slot = None
+
+        metrics.TOKENS.inc(sequence.generated)
+        if sequence.generated > 1:
+            metrics.TOKEN_RATE.observe((sequence.generated - 1) / max(time.perf_counter() - sequence.first, 1e-6))
+
+        if error:
+            metrics.GENERATIONS.inc(result="error")
+            sequence.respond({"type": "error", "data": {"message": error}})
+            return
+
+        errored = sequence.abort
+        metrics.GENERATIONS.inc(result="aborted" if errored else "done")
+        sequence.respond({
+            "type": "output",
+            "data": {
+                "parameters": sequence.data.copy(),
+                "model": self.model.copy(),
+                "output": sequence.stopper.output if sequence.stopper else "",
+                "errored": errored,
+                "reused": sequence.reused
+            }
+        })
+        sequence.respond({"type": "aborted"} if errored else {"type": "done"})
@@ -0,0 +1,159 @@
+import os
+import json
+import time
+import array
+import pickle
+import hashlib
+import threading
+
+CACHE_SIZE = 8 * 1024 * 1024 * 1024
+CACHE_MIN_TOKENS = 1024
+
+# every Inference has its own StateCache over the same folder, the index is shared through the file
+INDEX_LOCK = threading.Lock()
+
+def hash_tokens(tokens):
+    return hashlib.sha256(array.array("q", tokens).tobytes()).hexdigest()
+
+class StateCache():
+    def __init__(self, path, size=CACHE_SIZE):
+        self.path = path
+        self.size = size
+        self.model = None
+        self.index = {}
+        self.writer = None
+        self.readIndex()
+
+    def readIndex(self):
+        try:
+            with open(os.path.join(self.path, "index.json"), "r", encoding="utf-8") as f:
+                self.index = json.load(f)
+        except Exception:
+            pass
+
+    def writeIndex(self, added={}, removed=[]):
+        # merged into what is on disk, other instances and processes write it too
+        self.readIndex()
+        self.index.update(added)
+        for name in removed:
+            self.index.pop(name, None)
+        self.index = {n: e for n, e in self.index.items() if os.path.exists(os.path.join(self.path, n))}
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            tmp = os.path.join(self.path, f"index.json.{os.getpid()}.{threading.get_ident()}.tmp")
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self.index, f, indent=4)
+            os.replace(tmp, os.path.join(self.path, "index.json"))
+        except Exception:
+            pass
+
+    def setModel(self, model_path, parameters=None):
+        if not model_path:
+            self.model = None
+            return
+
+        stat = os.stat(model_path)
+        key = json.dumps({
+            "model_path": os.path.abspath(model_path),
+            "model_size": stat.st_size,
+            "model_time": stat.st_mtime,
+            "parameters": parameters or {}
+        }, sort_keys=True)
+        self.model = hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+
+    def find(self, tokens):
+        if not self.model:
+            return None, 0
+
+        with INDEX_LOCK:
+            self.readIndex()
+        entries = [(e["length"], name) for name, e in self.index.items() if e["model"] == self.model]
+        for length, name in sorted(entries, reverse=True):
+            if length <= len(tokens) and self.index[name]["hash"] == hash_tokens(tokens[:length]):
+                return name, length
+        return None, 0
+
+    def get(self, name):
+        file = os.path.join(self.path, name)
+        try:
+            with open(file, "rb") as f:
+                data = pickle.load(f)
+        except Exception:
+            with INDEX_LOCK:
+                self.writeIndex(removed=[name])
+            return None
+
+        # recency lives on the file so eviction sees it from any process
+        try:
+            os.utime(file)
+        except Exception:
+            pass
+        return data
+
+    def putLater(self, tokens, state):
+        # the write can take a while for big states, one at a time so they don't pile up in memory
+        if self.writer and self.writer.is_alive():
+            return
+        self.writer = threading.Thread(target=self.put, args=(tokens, state, self.model), daemon=True)
+        self.writer.start()
+
+    def put(self, tokens, state, model=None):
+        model = model or self.model
+        if not model:
+            return
+
+        name = f"{model}-{hash_tokens(tokens)[:16]}.state"
+        data = {
+            "input_ids": state.input_ids[:state.n_tokens].tolist(),
+            "n_tokens": state.n_tokens,
+            "llama_state": state.llama_state,
+            "llama_state_size": state.llama_state_size
+        }
+
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            file = os.path.join(self.path, name)
+            tmp = f"{file}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, file)
+            size = os.path.getsize(file)
+        except Exception:
+            return
+
+        entry = {
+            "model": model,
+            "length": len(tokens),
+            "hash": hash_tokens(tokens),
+            "size": size,
+            "time": time.time()
+        }
+        with INDEX_LOCK:
+            self.writeIndex(added={name: entry}, removed=self.evict())
+
+    def evict(self):
+        # from the files on disk, so states another instance never indexed still count
+        try:
+            names = [n for n in os.listdir(self.path) if n.endswith(".state")]
+        except Exception:
+            return []
+        files = []
+        for name in names:
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except Exception:
+                continue
+            files += [(stat.st_mtime, stat.st_size, name)]
+
+        total = sum(size for _, size, _ in files)
+        removed = []
+        for _, size, name in sorted(files):
+            if total <= self.size:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except Exception:
+                continue
+            total -= size
+            removed += [name]
+        return removed
@@ -0,0 +1,216 @@
+import json
+import time
+import queue
+import secrets
+
+import metrics
+
+RESPONSE_TIMEOUT = 600
+DEFAULT_TOKENS = 16
+DEFAULT_LOAD = {"n_gpu_layers": 128, "n_ctx": 2048}
+PASSTHROUGH = ["temperature", "top_p", "top_k", "min_p", "repeat_penalty", "frequency_penalty", "presence_penalty", "stop", "seed"]
+
+class APIError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+class TransientClient():
+    # one http request is one scheduler client, gone again when the request ends
+    def __init__(self, scheduler, id):
+        self.scheduler = scheduler
+        self.id = id
+        self.responses = queue.Queue()
+        scheduler.connect(id, self.responses.put)
+
+    def submit(self, request):
+        self.scheduler.submit(self.id, request)
+
+    def next(self):
+        try:
+            return self.responses.get(timeout=RESPONSE_TIMEOUT)
+        except queue.Empty:
+            raise APIError(504, "inference timed out")
+
+    def wait(self, types):
+        while True:
+            response = self.next()
+            if response["type"] == "error":
+                raise APIError(500, response["data"]["message"])
+            if response["type"] in types:
+                return response
+
+    def close(self):
+        self.scheduler.disconnect(self.id)
+
+def get_generate(body):
+    prompt = body.get("prompt", "")
+    if isinstance(prompt, list):
+        if len(prompt) != 1 or not isinstance(prompt[0], str):
+            raise APIError(400, "prompt must be a single string")
+        prompt = prompt[0]
+    if not isinstance(prompt, str):
+        raise APIError(400, "prompt must be a single string")
+
+    data = {k: body[k] for k in PASSTHROUGH if body.get(k) != None}
+    data["prompt"] = prompt
+    data["max_tokens"] = int(body.get("max_tokens") or DEFAULT_TOKENS)
+    data["stop_condition"] = "None"
+    return {"type": "generate", "data": data}
+
+def make_chunk(id, model, text, finish=None):
+    return {
+        "id": id,
+        "object": "text_completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"text": text, "index": 0, "logprobs": None, "finish_reason": finish}]
+    }
+
+class CompletionsHandler(metrics.MetricsHandler):
+    scheduler = None
+    clients = None
+    key = None
+
+    def sendJSON(self, status, obj):
+        body = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def sendError(self, status, message):
+        self.sendJSON(status, {"error": {"message": message, "type": "invalid_request_error" if status < 500 else "server_error"}})
+
+    def sendEvent(self, obj):
+        data = obj if isinstance(obj, str) else json.dumps(obj)
+        self.wfile.write(f"data: {data}\n\n".encode("utf-8"))
+        self.wfile.flush()
+
+    def authorized(self):
+        if not self.key:
+            return True
+        header = self.headers.get("Authorization", "")
+        return secrets.compare_digest(header.encode("utf-8"), f"Bearer {self.key}".encode("utf-8"))
+
+    def readBody(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            raise APIError(400, "invalid json")
+        if not isinstance(body, dict):
+            raise APIError(400, "invalid json")
+        return body
+
+    def do_GET(self):
+        path = self.path.split("?", 1)[0]
+        if path not in {"/metrics", "/v1/models"}:
+            self.sendError(404, "not found")
+            return
+        if not self.authorized():
+            self.sendError(401, "invalid api key")
+            return
+        if path == "/metrics":
+            super().do_GET()
+            return
+
+        client = TransientClient(self.scheduler, next(self.clients))
+        try:
+            client.submit({"type": "options"})
+            options = client.wait({"options"})["data"]["models"]
+        except APIError as e:
+            self.sendError(e.status, str(e))
+            return
+        finally:
+            client.close()
+
+        self.sendJSON(200, {"object": "list", "data": [{"id": m, "object": "model", "owned_by": "lineworks"} for m in options]})
+
+    def do_POST(self):
+        if self.path.split("?", 1)[0] != "/v1/completions":
+            self.sendError(404, "not found")
+            return
+        if not self.authorized():
+            self.sendError(401, "invalid api key")
+            return
+
+        client = TransientClient(self.scheduler, next(self.clients))
+        try:
+            body = self.readBody()
+            request = get_generate(body)
+            model = self.load(client, body.get("model"))
+            self.complete(client, request, model, bool(body.get("stream")))
+        except APIError as e:
+            self.sendError(e.status, str(e))
+        finally:
+            client.close()
+
+    def load(self, client, name):
+        # attach to a model that is already warm, only load one if that evicts nobody
+        client.submit({"type": "models"})
+        warm = client.wait({"models"})["data"]
+        parameters = None
+        for p in warm["models"]:
+            if not name or p["model_path"] == name:
+                parameters = p
+                break
+
+        if not parameters:
+            if not name:
+                raise APIError(404, "no model loaded")
+            if warm["capacity"] <= 0:
+                raise APIError(503, f"model '{name}' is not loaded")
+            client.submit({"type": "options"})
+            if name not in client.wait({"options"})["data"]["models"]:
+                raise APIError(404, f"model '{name}' does not exist")
+            parameters = {"model_path": name, **DEFAULT_LOAD}
+
+        client.submit({"type": "load", "data": parameters})
+        client.wait({"done"})
+        return parameters["model_path"]
+
+    def complete(self, client, request, model, stream):
+        id = "cmpl-" + secrets.token_hex(12)
+        client.submit(request)
+
+        if not stream:
+            text = []
+            while True:
+                response = client.next()
+                typ = response["type"]
+                if typ == "stream":
+                    text += [response["data"]["next"]]
+                if typ == "error":
+                    raise APIError(500, response["data"]["message"])
+                if typ in {"done", "aborted"}:
+                    break
+            self.sendJSON(200, make_chunk(id, model, "".join(text), "stop"))
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        try:
+            while True:
+                response = client.next()
+                typ = response["type"]
+                if typ == "stream" and response["data"]["next"]:
+                    self.sendEvent(make_chunk(id, model, response["data"]["next"]))
+                if typ == "error":
+                    self.sendEvent({"error": {"message": response["data"]["message"], "type": "server_error"}})
+                    break
+                if typ in {"done", "aborted"}:
+                    self.sendEvent(make_chunk(id, model, "", "stop"))
+                    break
+            self.sendEvent("[DONE]")
+        except APIError as e:
+            self.sendEvent({"error": {"message": str(e), "type": "server_error"}})
+        except (BrokenPipeError, ConnectionResetError):
+            # the caller went away, disconnecting the client aborts its generation
+            pass
+
+def make_handler(scheduler, clients, key=None):
+    return type("Handler", (CompletionsHandler,), {"scheduler": scheduler, "clients": clients, "key": key})
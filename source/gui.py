@@ -49,6 +49,7 @@ class HistoryEntry(QObject):
         self._parameters = {}
         self._model = {}
         self._output = ""
+        self._backend = ""
         self._time = 0
         self._index = 0
 
@@ -62,6 +63,10 @@ class HistoryEntry(QObject):
     def id(self):
         return str(self._time)
     
+    @pyqtProperty(str, notify=updated)
+    def backend(self):
+        return self._backend
+    
     @pyqtProperty(int, notify=updated)
     def index(self):
         return self._index
@@ -102,7 +107,8 @@ class HistoryEntry(QObject):
             "index": self._index,
             "trailing": self._trailing,
             "gen": copy.deepcopy(self._parameters),
-            "model": copy.deepcopy(self._model)
+            "model": copy.deepcopy(self._model),
+            "backend": self._backend
         }
         return data
     
@@ -114,6 +120,7 @@ class HistoryEntry(QObject):
         self._trailing = data["trailing"]
         self._parameters = copy.deepcopy(data["gen"])
         self._model = copy.deepcopy(data["model"])
+        self._backend = data.get("backend", "")
         self.updated.emit()
 
 class GUI(QObject):
@@ -182,6 +189,8 @@ class GUI(QObject):
         self._stream_overlay = True
         self._position_overlay = True
         self._color_scheme = 1
+        self._stream_interval = backend.STREAM_INTERVAL
+        self._first_token_timeout = backend.FIRST_TOKEN_TIMEOUT
         self._mode = mode
 
         self._dictionary = spellcheck.Dictionary()
@@ -204,6 +213,8 @@ class GUI(QObject):
         self.getVersionInfo()
 
         self._backend = None
+        self._stream = backend.StreamCoalescer(self)
+        self._stream.response.connect(self.onResponse)
 
         self._backend_parameters.updated.connect(self.backendUpdated)
         parent.aboutToQuit.connect(self.stop)
@@ -356,6 +367,7 @@ class GUI(QObject):
             if not self._backend.wait(500):
                 self._backend.terminate()
 
+        self._stream.reset()
         self.resetState()
         self.saveConfig()
 
@@ -365,12 +377,18 @@ class GUI(QObject):
         else:
             endpoint = self._backend_parameters.get("endpoint")
             key = self._backend_parameters.get("key")
-            if endpoint.startswith("ws"):
+            endpoints = [e.strip() for e in endpoint.split(",") if e.strip()]
+            if len(endpoints) > 1:
+                # several endpoints are routed between, keys are matched up by position
+                keys = [k.strip() for k in key.split(",")]
+                keys += [""] * (len(endpoints) - len(keys))
+                self._backend = backend.RouterBackend(self, list(zip(endpoints, keys)), self._first_token_timeout)
+            elif endpoint.startswith("ws"):
                 self._backend = backend.RemoteBackend(self, endpoint, key)
             else:
                 self._backend = backend.APIBackend(self, endpoint, key)
             
-        self._backend.response.connect(self.onResponse)
+        self._backend.response.connect(self._stream.onResponse)
         self._backend.start()
 
         self.workingUpdated.emit()
@@ -616,7 +634,8 @@ class GUI(QObject):
         area = self._tabs.current
         self._current_tab = area._tabs[area.current]
         parameters = copy.deepcopy(self._gen_parameters._map)
-        if parameters["min_p"] > 0.0 and not self.isAPI:
+        # the router applies this per backend, API backends have no min_p to make up for it
+        if parameters["min_p"] > 0.0 and not self.isAPI and type(self._backend) != backend.RouterBackend:
             parameters["top_p"] = 1.0
             parameters["top_k"] = 0
 
@@ -639,6 +658,7 @@ class GUI(QObject):
         self._current_entry._context = self._current_tab.context()
         self._current_entry._trailing = self._current_tab.trailing()
         self._current_entry._parameters = copy.deepcopy(parameters)
+        self._current_entry._backend = "Local" if not self.isRemote else self._backend_parameters.get("endpoint")
 
         model = copy.deepcopy(self._model_parameters._map)
         del model["model_paths"]
@@ -721,6 +741,7 @@ class GUI(QObject):
             output = ''.join([c for c in response["data"]["output"] if ord(c) < 0x10000])
             if self._current_entry and output.strip():
                 self._current_entry._output = output
+                self._current_entry._backend = response["data"].get("backend", self._current_entry._backend)
                 self._current_entry._time = int(time.time()*1000)
                 self.addHistory(self._current_entry)
             
@@ -777,7 +798,9 @@ class GUI(QObject):
                 "spell_overlay": self._spell_overlay,
                 "stream_overlay": self._stream_overlay,
                 "position_overlay": self._position_overlay,
-                "color_scheme": self._color_scheme
+                "color_scheme": self._color_scheme,
+                "stream_interval": self._stream_interval,
+                "first_token_timeout": self._first_token_timeout
             },
             "remote": self._backend_parameters._map["mode"] == "Remote",
             "endpoint": self._backend_parameters._map["endpoint"],
@@ -827,6 +850,9 @@ class GUI(QObject):
         self._stream_overlay = settings.get("stream_overlay", self._stream_overlay)
         self._position_overlay = settings.get("position_overlay", self._position_overlay)
         self._color_scheme = settings.get("color_scheme", self._color_scheme)
+        self._stream_interval = settings.get("stream_interval", self._stream_interval)
+        self._first_token_timeout = settings.get("first_token_timeout", self._first_token_timeout)
+        self._stream.setInterval(self._stream_interval)
 
         self.settingsUpdated.emit()
 
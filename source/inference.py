@@ -4,9 +4,15 @@ import sys
 import datetime
 import traceback
 import re
+import threading
+import time
+
+import cache
+import metrics
 
 PARAGRAPH_MATCH = re.compile(r"(.+\n[\s\n]*\n)", flags=re.UNICODE)
 LINE_MATCH = re.compile(r"(.+\n)", flags=re.UNICODE)
+CONTEXT_SHIFT = 4
 
 def log_traceback(label):
     exc_type, exc_value, exc_tb = sys.exc_info()
@@ -17,53 +23,241 @@ def log_traceback(label):
     return tb
 
 def split_sentences(text):
-    def get(i):
-        if i < len(text):
-            return f"{text[i]}"
-        return None
-    
     sentences = []
-    sentence = ""
-    end = False
+    start = 0
     alpha = False
-    while text:
-        if end:
-            end = False
-            alpha = False
-            sentences += [sentence]
-            sentence = ""
-        
-        a, b, c = get(0), get(1), get(2)
+    i, n = 0, len(text)
+    while i < n:
+        a = text[i]
+        b = text[i+1] if i + 1 < n else None
 
         if a.isalpha():
             alpha = True
 
-        if a in '.!?' and (b and b in '"') and alpha:
-            sentence += a + b
-            text = text[2:]
-            end = True
-            continue
-        
-        if a in '.!?…' and ((b and b in ' ') or not b) and alpha:
-            sentence += a
-            text = text[1:]
-            end = True
-            continue
+        end = None
+        if alpha:
+            if a in '.!?' and b == '"':
+                end, i = i + 2, i + 2
+            elif a in '.!?…' and (b == ' ' or b == None):
+                end, i = i + 1, i + 1
+            elif a != '\n' and b == '\n':
+                # the newline also starts the next sentence
+                end, i = i + 2, i + 1
 
-        if not a in '\n' and (b and b in '\n') and alpha:
-            sentence += a + b
-            text = text[1:]
-            end = True
+        if end == None:
+            i += 1
             continue
-            
-        sentence += a
-        text = text[1:]
 
-    if end:
-        sentences += [sentence]
-        sentence = ""
+        sentences += [text[start:end]]
+        start = i
+        alpha = False
+
+    return text[start:], sentences
+
+def trailing_sentence(text):
+    # a sentence ends at the first boundary after an alphabetic character,
+    # so only the text back to the last ending boundary needs scanning
+    n = len(text)
+    found = None
+    for i in range(n - 1, -1, -1):
+        a = text[i]
+        b = text[i+1] if i + 1 < n else None
+
+        if a in '.!?' and b == '"':
+            found = i + 2
+        elif a in '.!?…' and (b == ' ' or b == None):
+            found = i + 1
+        elif a != '\n' and b == '\n':
+            found = i + 1
+
+        if found != None and a.isalpha():
+            return text[found:]
+    return text
+
+def get_tokens(llm, prompt, n_keep, n_ctx):
+    bos = llm.token_bos()
+    if prompt == "":
+        return [bos], prompt
+
+    tokens = llm.tokenize(prompt.encode("utf-8"))
+    if len(tokens) <= n_keep:
+        return tokens, prompt
+
+    # drop the front in whole blocks so the window start stays put while
+    # the document grows, keeping the evaluated prefix reusable
+    head = tokens[:1] if tokens[0] == bos else []
+    shift = max(n_ctx // CONTEXT_SHIFT, 1)
+    drop = len(tokens) - max(n_keep, len(head))
+    drop = -(-drop // shift) * shift
+    tokens = head + tokens[len(head)+drop:]
+
+    prompt = llm.detokenize(tokens[len(head):]).decode("utf-8", errors="ignore")
+    return tokens, prompt
+
+class Binding():
+    def __init__(self):
+        self.module = None
+        self.Llama = None
+        self.LlamaState = None
+        self.error = None
+
+BINDING = None
+BINDING_LOCK = threading.Lock()
+
+def get_binding():
+    global BINDING
+    if BINDING:
+        return BINDING
+
+    with BINDING_LOCK:
+        if BINDING:
+            return BINDING
+
+        binding = Binding()
+        module = None
+        try:
+            import llama_cpp_cuda as module
+        except ModuleNotFoundError:
+            pass
+        except Exception as e:
+            log_traceback("IMPORT (CUDA)")
+            binding.error = str(e)
+
+        if not binding.error and not module:
+            try:
+                import llama_cpp as module
+            except Exception as e:
+                log_traceback("IMPORT")
+                binding.error = str(e)
+
+        if module:
+            try:
+                binding.module = module
+                binding.Llama = module.Llama
+                binding.LlamaState = module.LlamaState
+            except Exception as e:
+                log_traceback("IMPORT")
+                binding.error = str(e)
+
+        BINDING = binding
+    return BINDING
+
+class StopCondition():
+    def __init__(self, condition, prompt=""):
+        self.condition = condition
+        self.chunks = []
+
+        # sentence state, scanning over context + output
+        self.context = 0
+        self.length = 0
+        self.pending = ""
+        self.alpha = False
 
-    return sentence, sentences
+        # line/paragraph state
+        self.last = None
+        self.armed = False
+
+        if condition == "Sentence":
+            context = trailing_sentence(prompt).lstrip()
+            self.context = len(context)
+            self.length = len(context)
+            self.pending = context
+
+    @property
+    def output(self):
+        if len(self.chunks) > 1:
+            self.chunks = ["".join(self.chunks)]
+        return self.chunks[0] if self.chunks else ""
+
+    def append(self, next):
+        self.chunks += [next]
+        self.length += len(next)
+
+    def scanSentence(self, next):
+        # only the first sentence matters, positions before the last character
+        # are final once scanned, the last character is checked as if at the end
+        text = self.pending + next
+        start = self.length - len(self.pending)
+        alpha = self.alpha
+        i, n = 0, len(text)
+        while i < n - 1:
+            a, b = text[i], text[i+1]
+            if a.isalpha():
+                alpha = True
+            if alpha:
+                if a in '.!?' and b == '"':
+                    return start + i + 2
+                if a in '.!?…' and b == ' ':
+                    return start + i + 1
+                if a != '\n' and b == '\n':
+                    return start + i + 2
+            i += 1
+
+        self.alpha = alpha
+        self.pending = text[i:]
+        if n and alpha and text[-1] in '.!?…':
+            return start + n
+        return None
+
+    def feedSentence(self, next):
+        end = self.scanSentence(next)
+        if end == None:
+            self.append(next)
+            return next, False
+
+        if end >= self.length:
+            cut = next[:end-self.length]
+            output = self.output + cut
+        else:
+            cut = ""
+            output = self.output[:max(end-self.context, 0)]
+
+        if not output.strip():
+            # sentence was completed by the context, restart from the output
+            self.append(next)
+            self.context = 0
+            self.pending = self.output
+            self.length = len(self.pending)
+            self.alpha = False
+            return next, False
+
+        self.chunks = [output]
+        return cut, True
+
+    def feedLine(self, next, paragraph):
+        for i, c in enumerate(next):
+            if c == '\n' and self.armed:
+                end = i + 1
+                for j in range(i + 1, len(next)):
+                    if not next[j].isspace():
+                        break
+                    if next[j] == '\n':
+                        end = j + 1
+                next = next[:end]
+                self.append(next)
+                return next, True
+            elif c == '\n' and self.last != None and self.last != '\n':
+                if not paragraph:
+                    next = next[:i+1]
+                    self.append(next)
+                    return next, True
+                self.armed = True
+            elif not c.isspace():
+                self.armed = False
+            self.last = c
+
+        self.append(next)
+        return next, False
+
+    def feed(self, next):
+        if self.condition == "Sentence":
+            return self.feedSentence(next)
+        if self.condition == "Paragraph":
+            return self.feedLine(next, True)
+        if self.condition == "Line":
+            return self.feedLine(next, False)
+        self.append(next)
+        return next, False
 
 class Inference():
     def __init__(self, models_path, response):
@@ -72,6 +266,7 @@ class Inference():
         self.model = None
         self.models_path = models_path
         self.callback = response
+        self.cache = cache.StateCache(os.path.join(os.path.dirname(os.path.abspath(models_path)), "cache"))
 
     def respond(self, response):
         self.callback(response)
@@ -92,30 +287,46 @@ class Inference():
     def stop(self):
         self.abort = True
 
-    def process(self, request):
-        loaded = False
-        err = None
-        try:
-            from llama_cpp_cuda import Llama
-            loaded = True
-        except ModuleNotFoundError:
-            pass
-        except Exception as e:
-            log_traceback("IMPORT (CUDA)")
-            err = e
-            pass
+    def getTokens(self, prompt, n_keep):
+        return get_tokens(self.llm, prompt, n_keep, self.llm._n_ctx)
 
-        if not err and not loaded:        
-            try:
-                from llama_cpp import Llama
-                loaded = True
-            except Exception as e:
-                log_traceback("IMPORT")
-                err = e
-                pass
+    def getReused(self, tokens):
+        # llama-cpp only evaluates the tokens after the longest common prefix
+        # with what is already in the KV cache, the last token is always redone
+        evaluated = self.llm._input_ids
+        reused = 0
+        for a, b in zip(evaluated, tokens[:-1]):
+            if a != b:
+                break
+            reused += 1
+        return reused
 
-        if not loaded:
-            self.setError("failed to load llama-cpp-python: " + str(err))
+    def restoreState(self, tokens):
+        name, length = self.cache.find(tokens)
+        if not name or length <= self.getReused(tokens):
+            return
+
+        data = self.cache.get(name)
+        if not data:
+            return
+        
+        try:
+            input_ids = self.llm.input_ids.copy()
+            input_ids[:data["n_tokens"]] = data["input_ids"]
+            self.llm.load_state(get_binding().LlamaState(
+                input_ids=input_ids,
+                scores=self.llm.scores,
+                n_tokens=data["n_tokens"],
+                llama_state=data["llama_state"],
+                llama_state_size=data["llama_state_size"]
+            ))
+        except Exception:
+            log_traceback("CACHE")
+            self.llm.reset()
+
+    def process(self, request):
+        if request["type"] in {"load", "generate"} and get_binding().error:
+            self.setError("failed to load llama-cpp-python: " + get_binding().error)
             return
 
         try:
@@ -130,8 +341,12 @@ class Inference():
                     self.model = req["data"].copy()
                     model_path = req["data"]["model_path"]
                     req["data"]["model_path"] = os.path.join(self.models_path, f"{model_path}.gguf")
-                    self.llm = Llama(verbose=False, **req["data"])
+                    start = time.perf_counter()
+                    self.llm = get_binding().Llama(verbose=False, **req["data"])
+                    metrics.MODEL_LOAD.observe(time.perf_counter() - start)
+                    self.cache.setModel(req["data"]["model_path"], self.model)
                 except Exception as e:
+                    self.cache.setModel(None)
                     log_traceback("INFERENCE")
                     self.setError("failed to load model: " + str(e))
                     return
@@ -142,6 +357,7 @@ class Inference():
                 if self.llm:
                     self.llm._model.__del__()
                 self.llm = None
+                self.cache.setModel(None)
                 self.setDone()
                 return
             if typ == "options":
@@ -159,74 +375,30 @@ class Inference():
                     return
                 self.setStatus("generating")
 
-                prompt = req["data"]["prompt"]
                 n_ctx = self.llm._n_ctx
                 n_req = req["data"]["max_tokens"]
-                if prompt != "":
-                    prompt_tokens = self.llm.tokenize(prompt.encode("utf-8"))
-                    if len(prompt_tokens) + n_req > n_ctx:
-                        prompt_tokens = prompt_tokens[-(n_ctx-n_req):]
-                        prompt = self.llm.detokenize(prompt_tokens).decode("utf-8")
-                        req["data"]["prompt"] = prompt
+                prompt_tokens, req["data"]["prompt"] = self.getTokens(req["data"]["prompt"], n_ctx - n_req)
+                self.restoreState(prompt_tokens)
+                reused = self.getReused(prompt_tokens)
                 
                 stop = req["data"]["stop_condition"]
                 del req["data"]["stop_condition"]
 
-                stream = self.llm(echo=False, stream=True, **req["data"])
+                parameters = {k:v for k,v in req["data"].items() if k != "prompt"}
+                start = time.perf_counter()
+                stream = self.llm(prompt_tokens, echo=False, stream=True, **parameters)
 
-                stop_context = ""
-                if stop == "Sentence":
-                    sentence, _ = split_sentences(req["data"]["prompt"])
-                    stop_context = sentence.lstrip()
-
-                output = ""
+                stopper = StopCondition(stop, req["data"]["prompt"])
 
                 errored = False
-                stopping = False
+                first = None
+                tokens = 0
                 for o in stream:
-                    next = o["choices"][0]["text"]
-
-                    if stop == "Sentence":
-                        tmp = stop_context + output + next
-
-                        sentence, sentences = split_sentences(tmp)
-                        sentences += [sentence]
-
-                        if len(sentences) > 1:
-                            sentence = sentences[0]
-                            next_tmp = sentence[len(stop_context + output):]
-                            output_tmp = sentence[len(stop_context):]
-                            if not output_tmp.strip():
-                                stop_context = ""
-                                output += next
-                            else:
-                                next = next_tmp
-                                output = output_tmp
-                                stopping = True
-                        else:
-                            output += next
-                    elif stop == "Paragraph":
-                        tmp = output + next
-                        match = PARAGRAPH_MATCH.search(output + next)
-                        if match:
-                            paragraph = tmp[:match.end()]
-                            next = paragraph[len(output):]
-                            output = paragraph
-                            stopping = True
-                        else:
-                            output += next
-                    elif stop == "Line":
-                        tmp = output + next
-                        match = LINE_MATCH.search(output + next)
-                        if match:
-                            paragraph = tmp[:match.end()]
-                            next = paragraph[len(output):]
-                            output = paragraph
-                            stopping = True
-                        else:
-                            output += next
-                    elif stop == "None":
-                        output += next
+                    tokens += 1
+                    if first == None:
+                        first = time.perf_counter()
+                        metrics.PROMPT_EVAL.observe(first - start)
+                    next, stopping = stopper.feed(o["choices"][0]["text"])
 
                     self.respond({"type":"stream", "data": {"next": next}})
                     if stopping:
@@ -235,6 +407,16 @@ class Inference():
                     if self.abort:
                         errored = True
                         break
+                output = stopper.output
+
+                metrics.TOKENS.inc(tokens)
+                metrics.GENERATIONS.inc(result="aborted" if errored else "done")
+                if tokens > 1:
+                    metrics.TOKEN_RATE.observe((tokens - 1) / max(time.perf_counter() - first, 1e-6))
+
+                state = None
+                if not errored and len(prompt_tokens) - reused >= cache.CACHE_MIN_TOKENS:
+                    state = self.llm.save_state()
                 
                 rsp = {
                     "type": "output",
@@ -242,7 +424,8 @@ class Inference():
                         "parameters": req["data"].copy(),
                         "model": self.model.copy(),
                         "output": output,
-                        "errored": errored
+                        "errored": errored,
+                        "reused": reused
                     }
                 }
                 self.respond(rsp)
@@ -250,6 +433,10 @@ class Inference():
                     self.setDone()
                 else:
                     self.setAborted()
+
+                # written out after the reply, big states take a while to reach the disk
+                if state:
+                    self.cache.putLater(prompt_tokens, state)
                 return
         except Exception as e:
             self.setError(str(e))
\ No newline at end of file
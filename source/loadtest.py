@@ -0,0 +1,239 @@
+import time
+import random
+import secrets
+import argparse
+import threading
+
+import websockets.sync.client
+import websockets.exceptions
+
+import server
+
+WORDS = "the a and of to in was she he it said that her his had with for on at but they you not be".split()
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+class FakeSequence():
+    def __init__(self):
+        self.abort = False
+        self.done = False
+
+class FakeInference():
+    # stands in for Inference, tokens come out at a fixed rate after a fixed prompt latency
+    def __init__(self, models_path, response, rate=50.0, latency=0.05, parallel=False):
+        self.abort = False
+        self.llm = None
+        self.model = None
+        self.callback = response
+        self.rate = rate
+        self.latency = latency
+        self.batched = parallel
+
+    def process(self, request):
+        typ = request["type"]
+        if typ == "options":
+            self.callback({"type": "options", "data": {"models": ["fake"]}})
+        if typ == "load":
+            self.callback({"type": "status", "data": {"message": "loading"}})
+            self.llm = True
+            self.model = request["data"].copy()
+            self.callback({"type": "done"})
+        if typ == "unload":
+            self.callback({"type": "status", "data": {"message": "unloading"}})
+            self.llm = None
+            self.callback({"type": "done"})
+        if typ == "generate":
+            if self.batched:
+                self.generate(request, self.callback)
+            else:
+                self.stream(request, self.callback, self)
+
+    def generate(self, request, respond):
+        sequence = FakeSequence()
+        threading.Thread(target=self.stream, args=(request, respond, sequence), daemon=True).start()
+        return sequence
+
+    def stream(self, request, respond, state):
+        data = request["data"]
+        data.pop("stop_condition", None)
+        respond({"type": "status", "data": {"message": "generating"}})
+        time.sleep(self.latency)
+
+        rng = random.Random()
+        output = []
+        for i in range(data["max_tokens"]):
+            if state.abort:
+                break
+            next = " " + rng.choice(WORDS)
+            output += [next]
+            respond({"type": "stream", "data": {"next": next}})
+            time.sleep(1 / self.rate)
+
+        errored = state.abort
+        respond({
+            "type": "output",
+            "data": {
+                "parameters": data.copy(),
+                "model": (self.model or {}).copy(),
+                "output": "".join(output),
+                "errored": errored,
+                "reused": 0
+            }
+        })
+        respond({"type": "aborted"} if errored else {"type": "done"})
+        state.abort = False
+        state.done = True
+
+class Result():
+    def __init__(self):
+        self.ttft = None
+        self.latency = None
+        self.tokens = 0
+        self.aborted = False
+        self.error = None
+
+class LoadClient():
+    # speaks the same protocol as RemoteBackend, without Qt
+    def __init__(self, endpoint, key, features):
+        self.client = websockets.sync.client.connect(endpoint, max_size=None)
+        self.key = key
+        self.scheme = server.get_scheme(key)
+        self.method = None
+        self.pending = []
+
+        if features != None:
+            hello = server.make_hello(features)
+            hello["data"]["session"] = secrets.token_hex(16)
+            hello["data"]["resume"] = None
+            self.send(hello)
+            reply = self.recv()
+            if reply["type"] == "hello":
+                self.scheme = server.get_session_scheme(key, hello["data"]["nonce"], bytes(reply["data"]["nonce"]))
+                self.method = server.get_compression(reply["data"]["features"])
+            else:
+                self.pending = [reply]
+
+    def send(self, obj):
+        self.client.send(server.fragment(server.encrypt(self.scheme, obj, self.method)))
+
+    def recv(self):
+        if self.pending:
+            return self.pending.pop(0)
+        response = server.decrypt(self.scheme, self.client.recv(), self.method)
+        if response["type"] == "frame":
+            self.pending = response["data"]["responses"]
+            return self.pending.pop(0)
+        return response
+
+    def wait(self, types):
+        while True:
+            response = self.recv()
+            if response["type"] in types:
+                return response
+
+    def close(self):
+        self.client.close()
+
+    def generate(self, rng, tokens, abort):
+        result = Result()
+        prompt = " ".join(rng.choice(WORDS) for _ in range(rng.randint(50, 500)))
+        aborting = rng.random() < abort
+
+        start = time.perf_counter()
+        self.send({"type": "generate", "data": {"prompt": prompt, "max_tokens": tokens, "stop_condition": "None", "temperature": 1.0}})
+        while True:
+            response = self.recv()
+            typ = response["type"]
+            if typ == "stream" and result.ttft == None:
+                result.ttft = time.perf_counter() - start
+                if aborting:
+                    self.send({"type": "abort"})
+            if typ == "output":
+                result.tokens = len(response["data"]["output"].split())
+            if typ == "error":
+                result.error = response["data"]["message"]
+                break
+            if typ in {"done", "aborted"}:
+                result.aborted = typ == "aborted"
+                break
+        result.latency = time.perf_counter() - start
+        return result
+
+def run_client(endpoint, key, features, requests, tokens, abort, results, lock):
+    rng = random.Random()
+    try:
+        client = LoadClient(endpoint, key, features)
+        client.send({"type": "load", "data": {"model_path": "fake", "n_ctx": 2048}})
+        client.wait({"done", "error"})
+        for i in range(requests):
+            result = client.generate(rng, tokens, abort)
+            with lock:
+                results += [result]
+        client.close()
+    except Exception as e:
+        result = Result()
+        result.error = str(e)
+        with lock:
+            results += [result]
+
+def report(results, elapsed):
+    done = [r for r in results if not r.error]
+    errors = [r for r in results if r.error]
+    ttft = [r.ttft for r in done if r.ttft != None]
+    latency = [r.latency for r in done if not r.aborted]
+    tokens = sum(r.tokens for r in done)
+
+    print(f"requests:   {len(done)} ok, {sum(r.aborted for r in done)} aborted, {len(errors)} errors in {elapsed:.2f}s")
+    for label, values in [("ttft", ttft), ("latency", latency)]:
+        p = [percentile(values, q) * 1000 for q in (50, 95, 99)]
+        print(f"{label+':':<11} p50 {p[0]:.1f}ms  p95 {p[1]:.1f}ms  p99 {p[2]:.1f}ms")
+    print(f"throughput: {tokens / elapsed:.1f} tokens/s, {len(done) / elapsed:.2f} requests/s")
+    if errors:
+        print(f"first error: {errors[0].error}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='lineworks server load test')
+    parser.add_argument('--endpoint', type=str, help='existing server to test, otherwise one is started with a fake engine', default=None)
+    parser.add_argument('--bind', type=str, help='address (ip:port) for the started server', default="127.0.0.1:29998")
+    parser.add_argument('--key', type=str, help='key to derive encryption key from', default=server.DEFAULT_KEY)
+    parser.add_argument('--clients', type=int, help='concurrent clients', default=16)
+    parser.add_argument('--requests', type=int, help='generations per client', default=10)
+    parser.add_argument('--tokens', type=int, help='tokens per generation', default=64)
+    parser.add_argument('--rate', type=float, help='fake engine tokens per second', default=50.0)
+    parser.add_argument('--latency', type=float, help='fake engine seconds before the first token', default=0.05)
+    parser.add_argument('--abort', type=float, help='fraction of generations aborted after the first token', default=0.1)
+    parser.add_argument('--parallel', action='store_true', help='fake engine runs generations concurrently')
+    parser.add_argument('--legacy', action='store_true', help='skip the hello, as older clients do')
+    args = parser.parse_args()
+
+    features = None if args.legacy else server.FEATURES
+    remote = None
+    endpoint = args.endpoint
+    if not endpoint:
+        def factory(models_path, response):
+            return FakeInference(models_path, response, args.rate, args.latency, args.parallel)
+        ip, port = args.bind.rsplit(":",1)
+        remote = server.RemoteServer(ip, port, "models", args.key, factory=factory)
+        remote.start()
+        endpoint = f"ws://{ip}:{port}"
+
+    results = []
+    lock = threading.Lock()
+    threads = [threading.Thread(target=run_client, args=(endpoint, args.key, features, args.requests, args.tokens, args.abort, results, lock)) for _ in range(args.clients)]
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    report(results, time.perf_counter() - start)
+
+    if remote:
+        remote.stop()
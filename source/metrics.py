@@ -0,0 +1,201 @@
+import math
+import threading
+import http.server
+
+TIME_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+RATE_BUCKETS = [1, 2, 5, 10, 20, 30, 50, 75, 100, 150, 200]
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    inner = ",".join('{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"')) for k, v in labels)
+    return "{" + inner + "}"
+
+def format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+def format_family(name, help, kind, samples):
+    lines = [f"# HELP {name} {help}", f"# TYPE {name} {kind}"]
+    for sample, labels, value in samples:
+        lines += [f"{sample}{format_labels(labels)} {format_value(value)}"]
+    return lines
+
+class Metric():
+    def __init__(self, name, help, kind):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def key(self, labels):
+        return tuple(sorted(labels.items()))
+
+    def samples(self):
+        with self.lock:
+            return [(self.name, k, v) for k, v in self.values.items()]
+
+    def render(self):
+        return format_family(self.name, self.help, self.kind, self.samples())
+
+class Counter(Metric):
+    def __init__(self, name, help):
+        super().__init__(name, help, "counter")
+
+    def inc(self, value=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+class Gauge(Metric):
+    def __init__(self, name, help, collect=None):
+        super().__init__(name, help, "gauge")
+        self.collect = collect
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def inc(self, value=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def dec(self, value=1, **labels):
+        self.inc(-value, **labels)
+
+    def samples(self):
+        if not self.collect:
+            return super().samples()
+        # computed at scrape time, either a number or a list of (labels, value)
+        values = self.collect()
+        if not isinstance(values, list):
+            values = [({}, values)]
+        return [(self.name, self.key(labels), value) for labels, value in values]
+
+class Histogram(Metric):
+    def __init__(self, name, help, buckets=TIME_BUCKETS):
+        super().__init__(name, help, "histogram")
+        self.buckets = list(buckets) + [math.inf]
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self.values[key] = (counts, total + value)
+
+    def samples(self):
+        samples = []
+        with self.lock:
+            for key, (counts, total) in self.values.items():
+                for bound, count in zip(self.buckets, counts):
+                    samples += [(self.name + "_bucket", key + (("le", format_value(bound)),), count)]
+                samples += [(self.name + "_sum", key, total), (self.name + "_count", key, counts[-1])]
+        return samples
+
+class Registry():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+        self.sources = []
+
+    def register(self, metric):
+        # later registrations replace earlier ones, so collectors follow the newest owner
+        with self.lock:
+            self.metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, help):
+        return self.register(Counter(name, help))
+
+    def gauge(self, name, help, collect=None):
+        return self.register(Gauge(name, help, collect))
+
+    def histogram(self, name, help, buckets=TIME_BUCKETS):
+        return self.register(Histogram(name, help, buckets))
+
+    def forward(self, source):
+        # source returns (labels, snapshot) pairs from other processes, merged in at scrape time
+        with self.lock:
+            self.sources += [source]
+
+    def snapshot(self, exclude=()):
+        with self.lock:
+            metrics = [m for m in self.metrics.values() if m.name not in exclude]
+        families = []
+        for metric in metrics:
+            try:
+                families += [(metric.name, metric.help, metric.kind, metric.samples())]
+            except Exception:
+                continue
+        return families
+
+    def render(self):
+        with self.lock:
+            sources = list(self.sources)
+        families = {}
+        for name, help, kind, samples in self.snapshot():
+            families[name] = (help, kind, samples)
+        for source in sources:
+            try:
+                forwarded = source()
+            except Exception:
+                continue
+            for labels, snapshot in forwarded:
+                extra = tuple(sorted(labels.items()))
+                for name, help, kind, samples in snapshot:
+                    help, kind, merged = families.setdefault(name, (help, kind, []))
+                    merged += [(sample, extra + key, value) for sample, key, value in samples]
+
+        lines = []
+        for name, (help, kind, samples) in families.items():
+            lines += format_family(name, help, kind, samples)
+        return "\n".join(lines) + "\n"
+
+REGISTRY = Registry()
+
+TOKENS = REGISTRY.counter("lineworks_generated_tokens_total", "Tokens generated.")
+GENERATIONS = REGISTRY.counter("lineworks_generations_total", "Generations finished, by result.")
+TOKEN_RATE = REGISTRY.histogram("lineworks_generation_tokens_per_second", "Decode speed per generation.", RATE_BUCKETS)
+TIME_TO_FIRST_TOKEN = REGISTRY.histogram("lineworks_time_to_first_token_seconds", "Time from receiving a generate request to its first token.")
+PROMPT_EVAL = REGISTRY.histogram("lineworks_prompt_eval_seconds", "Time spent evaluating the prompt before the first token.")
+MODEL_LOAD = REGISTRY.histogram("lineworks_model_load_seconds", "Model load time.")
+BYTES_RECEIVED = REGISTRY.counter("lineworks_bytes_received_total", "Bytes received from clients.")
+BYTES_SENT = REGISTRY.counter("lineworks_bytes_sent_total", "Bytes sent to clients.")
+CRYPTO_TIME = REGISTRY.counter("lineworks_crypto_seconds_total", "Time spent encrypting and decrypting messages.")
+CONNECTIONS = REGISTRY.gauge("lineworks_connections", "Open websocket connections.")
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?", 1)[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class HTTPServer():
+    def __init__(self, host, port, handler=MetricsHandler):
+        self.server = http.server.ThreadingHTTPServer((host, int(port)), handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,242 @@
+import time
+import copy
+import json
+import threading
+import collections
+
+import inference
+import metrics
+
+MAX_MODELS = 1
+
+def model_key(parameters):
+    return json.dumps(parameters, sort_keys=True)
+
+class Model():
+    def __init__(self, key, parameters, engine):
+        self.key = key
+        self.parameters = parameters
+        self.engine = engine
+        self.users = set()
+        self.used = time.time()
+
+class Client():
+    def __init__(self, id, respond):
+        self.id = id
+        self.respond = respond
+        self.requests = collections.deque()
+        self.queued = False
+        self.model = None
+        self.sequences = []
+
+class Scheduler():
+    def __init__(self, models_path, max_models=MAX_MODELS, factory=inference.Inference):
+        self.models_path = models_path
+        self.max_models = max(max_models, 1)
+        self.factory = factory
+
+        self.models = {}
+        self.clients = {}
+        self.ready = collections.deque()
+        self.running = None
+        self.stopping = False
+
+        self.lister = self.factory(self.models_path, None)
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+        metrics.REGISTRY.gauge("lineworks_queue_depth", "Requests waiting per client.", self.getDepths)
+        metrics.REGISTRY.gauge("lineworks_active_generations", "Generations currently running.", self.getActive)
+        metrics.REGISTRY.gauge("lineworks_loaded_models", "Models kept loaded.", lambda: len(self.models))
+
+    def getDepths(self):
+        with self.condition:
+            return [({"client": id}, len(c.requests)) for id, c in self.clients.items()]
+
+    def getActive(self):
+        with self.condition:
+            active = sum(1 for c in self.clients.values() for s in c.sequences if not s.done)
+            return active + (1 if self.running else 0)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.stopping = True
+            if self.running:
+                self.running[1].abort = True
+            self.condition.notify_all()
+
+    def connect(self, id, respond):
+        with self.condition:
+            self.clients[id] = Client(id, respond)
+
+    def disconnect(self, id):
+        with self.condition:
+            client = self.clients.pop(id, None)
+            if not client:
+                return
+            client.requests.clear()
+            if self.running and self.running[0] == client:
+                self.running[1].abort = True
+            for sequence in client.sequences:
+                sequence.abort = True
+            if client.model in self.models:
+                self.models[client.model].users.discard(client.id)
+
+    def submit(self, id, request):
+        with self.condition:
+            client = self.clients.get(id)
+            if not client:
+                return
+
+            if request["type"] == "abort":
+                self.abort(client)
+                return
+
+            client.requests.append(request)
+            if not client.queued:
+                client.queued = True
+                self.ready.append(id)
+                self.condition.notify()
+
+    def abort(self, client):
+        if self.running and self.running[0] == client:
+            self.running[1].abort = True
+        for sequence in client.sequences:
+            sequence.abort = True
+        client.sequences = []
+
+        # generations that never started still need to end the stream
+        pending = [r for r in client.requests if r["type"] == "generate"]
+        for request in pending:
+            client.requests.remove(request)
+            client.respond({"type": "aborted"})
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.stopping and not self.ready:
+                    self.condition.wait()
+                if self.stopping:
+                    return
+
+                # one request per client per turn
+                id = self.ready.popleft()
+                client = self.clients.get(id)
+                if not client:
+                    continue
+                client.queued = False
+                if not client.requests:
+                    continue
+                request = client.requests.popleft()
+                if client.requests:
+                    client.queued = True
+                    self.ready.append(id)
+
+            try:
+                self.process(client, request)
+            except Exception as e:
+                inference.log_traceback("SCHEDULER")
+                client.respond({"type": "error", "data": {"message": str(e)}})
+
+            with self.condition:
+                if self.running:
+                    self.running[1].abort = False
+                self.running = None
+
+    def attach(self, client, model):
+        self.detach(client)
+        client.model = model.key
+        model.users.add(client.id)
+        model.used = time.time()
+
+    def detach(self, client):
+        model = self.models.get(client.model)
+        if model:
+            model.users.discard(client.id)
+        client.model = None
+
+    def free(self, model, exclude=None):
+        del self.models[model.key]
+        model.engine.callback = lambda response: None
+        model.engine.process({"type": "unload"})
+
+        for id in list(model.users):
+            client = self.clients.get(id)
+            if client and client.model == model.key:
+                client.model = None
+                if client == exclude:
+                    continue
+                client.respond({"type": "status", "data": {"message": "unloading"}})
+                client.respond({"type": "done"})
+
+    def evict(self, client):
+        while len(self.models) >= self.max_models:
+            model = min(self.models.values(), key=lambda m: (len(m.users) > 0, m.used))
+            self.free(model, client)
+
+    def process(self, client, request):
+        typ = request["type"]
+
+        if typ == "options":
+            self.lister.callback = client.respond
+            self.lister.process(request)
+            return
+
+        if typ == "models":
+            # what is warm right now, most recently used first
+            models = sorted(self.models.values(), key=lambda m: m.used, reverse=True)
+            client.respond({"type": "models", "data": {
+                "models": [copy.deepcopy(m.parameters) for m in models],
+                "capacity": self.max_models - len(models)
+            }})
+            return
+
+        if typ == "load":
+            key = model_key(request["data"])
+            model = self.models.get(key)
+            if model:
+                client.respond({"type": "status", "data": {"message": "loading"}})
+                self.attach(client, model)
+                client.respond({"type": "done"})
+                return
+
+            self.evict(client)
+            engine = self.factory(self.models_path, client.respond)
+            engine.process(copy.deepcopy(request))
+            if engine.llm:
+                model = Model(key, request["data"], engine)
+                self.models[key] = model
+                self.attach(client, model)
+            return
+
+        if typ == "unload":
+            client.respond({"type": "status", "data": {"message": "unloading"}})
+            model = self.models.get(client.model)
+            self.detach(client)
+            if model and not model.users:
+                self.free(model)
+            client.respond({"type": "done"})
+            return
+
+        if typ == "generate":
+            model = self.models.get(client.model)
+            if not model:
+                client.respond({"type": "error", "data": {"message": "no model loaded"}})
+                return
+            model.used = time.time()
+
+            engine = model.engine
+            if getattr(engine, "batched", False):
+                # batched engines decode on their own thread, so the next client can go
+                sequence = engine.generate(request, client.respond)
+                client.sequences = [s for s in client.sequences if not s.done] + [sequence]
+                return
+
+            with self.condition:
+                engine.callback = client.respond
+                self.running = (client, engine)
+            engine.process(request)
+            return
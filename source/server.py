@@ -1,24 +1,71 @@
 import time
 import copy
+import asyncio
 import argparse
 import threading
+import itertools
+import functools
+import collections
 
 import websockets.sync.client
-import websockets.sync.server
+import websockets.server
 import websockets.exceptions
 import secrets
+import hashlib
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.exceptions import InvalidTag
 import bson
+import zlib
 
-import inference
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+import scheduler
+import batch
+import metrics
+import workers
+import completions
 
 DEFAULT_KEY = "Lineworks"
 FRAGMENT_SIZE = 524288
+NONCE_SIZE = 16
+FRAME_INTERVAL = 0.016
+FRAME_SIZE = 65536
+MIRROR_COUNT = 8
+COMPRESS_SIZE = 1024
+CHANNEL_SIZE = 256
+CHANNEL_LIMIT = 65536
+RESUME_GRACE = 60
+FEATURES = ["frames", "deltas", "resume", "zlib"] + (["zstd"] if zstandard else [])
 
-def get_scheme(key):
+# preset dictionary for short payloads, protocol keys and common prose,
+# zlib favours matches near the end so the most frequent strings go last
+ZDICT = (
+    "model_path n_gpu_layers n_ctx max_tokens stop_condition Sentence Paragraph Line "
+    "temperature repeat_penalty min_p top_p top_k parameters errored reused output model "
+    "prompt delta mirror drop keep tail hash responses frame stream next status message "
+    "done error aborted options models generating loading unloading "
+    "\n\nChapter \n\n\"I don't know,\" she said. \"What do you mean?\" he asked. "
+    "couldn't wouldn't didn't wasn't there was something about the way "
+    "looked at him and then turned away from the door into the room, "
+    "She said that he was going to be with her. It was as if they had been "
+    "for a moment before it would have been one of the only thing she could "
+    " and the of the to the in the that was it was he was she was they were "
+).encode("utf-8")
+
+ZSTD_DICT = zstandard.ZstdCompressionDict(ZDICT, dict_type=zstandard.DICT_TYPE_RAWCONTENT) if zstandard else None
+
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+COMPRESSION_ZSTD = 2
+
+@functools.lru_cache(maxsize=8)
+def derive_key(key):
     key = key.encode("utf8")
     h = hashes.Hash(hashes.SHA256())
     h.update(key)
@@ -28,38 +75,363 @@ def get_scheme(key):
         salt=h.finalize()[:16],
         iterations=480000,
     )
-    return AESGCM(kdf.derive(key))
+    return kdf.derive(key)
+
+def get_scheme(key):
+    return AESGCM(derive_key(key))
+
+def get_session_scheme(key, client_nonce, server_nonce):
+    # cheap per connection key, the expensive derivation only happens once per process
+    hkdf = HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=client_nonce + server_nonce,
+        info=b"lineworks session",
+    )
+    return AESGCM(hkdf.derive(derive_key(key)))
+
+def make_hello(features):
+    return {"type": "hello", "data": {"nonce": secrets.token_bytes(NONCE_SIZE), "features": list(features)}}
+
+def get_compression(features):
+    if "zstd" in features and zstandard:
+        return COMPRESSION_ZSTD
+    if "zlib" in features:
+        return COMPRESSION_ZLIB
+    return None
+
+def compress(data, method):
+    # negotiated sessions always carry a method byte, small payloads aren't worth it
+    if len(data) >= COMPRESS_SIZE:
+        if method == COMPRESSION_ZSTD:
+            packed = zstandard.ZstdCompressor(level=3, dict_data=ZSTD_DICT).compress(data)
+        else:
+            method = COMPRESSION_ZLIB
+            c = zlib.compressobj(level=6, zdict=ZDICT)
+            packed = c.compress(data) + c.flush()
+        if len(packed) < len(data):
+            return bytes([method]) + packed
+    return bytes([COMPRESSION_NONE]) + data
+
+def decompress(data):
+    method, data = data[0], data[1:]
+    if method == COMPRESSION_ZLIB:
+        d = zlib.decompressobj(zdict=ZDICT)
+        return d.decompress(data) + d.flush()
+    if method == COMPRESSION_ZSTD:
+        if not zstandard:
+            raise ValueError("zstd unavailable")
+        return zstandard.ZstdDecompressor(dict_data=ZSTD_DICT).decompress(data)
+    return data
 
-def encrypt(scheme, obj):
+def encrypt(scheme, obj, method=None):
     data = bson.dumps(obj)
+    if method != None:
+        data = compress(data, method)
     if scheme:
         nonce = secrets.token_bytes(16)
         data = nonce + scheme.encrypt(nonce, data, b"")
     return data
 
-def decrypt(scheme, data):
+def decrypt(scheme, data, method=None):
     if scheme:
         data = scheme.decrypt(data[:16], data[16:], b"")
+    if method != None:
+        data = decompress(data)
     obj = bson.loads(data)
     return obj
 
+def hash_text(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
+def common_prefix(a, b):
+    # binary search on slice comparisons, these run at memcmp speed
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+def common_suffix(a, b):
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[len(a)-mid:] == b[len(b)-mid:]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+def make_delta(old, new):
+    # new = old[drop:drop+keep] + text + old[-tail:], drop covers the window sliding forward
+    drop = 0
+    if old[:64] != new[:64] and new:
+        found = old.find(new[:64])
+        if found > 0:
+            drop = found
+    keep = common_prefix(old[drop:], new)
+    tail = common_suffix(old[drop+keep:], new[keep:])
+    return {"drop": drop, "keep": keep, "tail": tail, "text": new[keep:len(new)-tail], "hash": hash_text(new)}
+
+def apply_delta(old, delta):
+    drop, keep, tail = delta["drop"], delta["keep"], delta["tail"]
+    new = old[drop:drop+keep] + delta["text"] + (old[len(old)-tail:] if tail else "")
+    if hash_text(new) != delta["hash"]:
+        return None
+    return new
+
+def fragment(data):
+    if len(data) <= FRAGMENT_SIZE:
+        return data
+    view = memoryview(data)
+    return [view[i:i+FRAGMENT_SIZE] for i in range(0, len(data), FRAGMENT_SIZE)]
+
+def response_size(response):
+    if response["type"] == "stream":
+        return len(response["data"]["next"]) + 32
+    return 256
+
+def make_frame(responses):
+    # adjacent stream chunks are merged, everything else keeps its order
+    merged = []
+    for response in responses:
+        if merged and response["type"] == "stream" and merged[-1]["type"] == "stream":
+            next = merged[-1]["data"]["next"] + response["data"]["next"]
+            merged[-1] = {"type": "stream", "data": {"next": next}}
+        else:
+            merged += [response]
+    if len(merged) == 1:
+        return merged[0]
+    return {"type": "frame", "data": {"responses": merged}}
+
+class ResponseChannel():
+    # responses from the scheduler thread to the connection's writer. stream chunks
+    # that queue up behind each other are merged, so a stalled client costs at most
+    # its unsent text, control messages are always kept
+    def __init__(self, loop, size=CHANNEL_SIZE, limit=CHANNEL_LIMIT):
+        self.loop = loop
+        self.size = size
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.items = collections.deque()
+        self.text = 0
+        self.controls = 0
+        self.readable = asyncio.Event()
+        self.writable = asyncio.Event()
+        self.writable.set()
+
+        # set when a generate is submitted, cleared by its first token
+        self.started = None
+
+        # the current generation, kept so a reconnecting client can resume it
+        self.log = None
+        self.tail = []
+        self.logging = False
+
+    @property
+    def stalled(self):
+        return self.text >= self.limit or self.controls >= self.size
+
+    def __call__(self, response):
+        self.put(response)
+
+    def record(self, response):
+        typ = response["type"]
+        if self.started and typ == "stream":
+            metrics.TIME_TO_FIRST_TOKEN.observe(time.perf_counter() - self.started)
+            self.started = None
+        elif typ in {"done", "aborted", "error"}:
+            self.started = None
+        if typ == "status" and response["data"]["message"] == "generating":
+            self.log, self.tail, self.logging = [], [], True
+        elif self.logging and typ == "stream":
+            self.log += [response["data"]["next"]]
+        elif self.logging:
+            self.tail += [copy.deepcopy(response)]
+            self.logging = typ not in {"done", "aborted", "error"}
+
+    def resume(self, hello, offset):
+        # everything queued was possibly lost with the old connection, rebuild from the log
+        with self.lock:
+            if offset != None and self.log != None:
+                text = "".join(self.log)
+                self.log = [text]
+                self.items.clear()
+                self.text = len(text) - min(offset, len(text))
+                if self.text:
+                    self.items.append({"type": "stream", "data": {"next": text[len(text)-self.text:]}})
+                self.items.extend(copy.deepcopy(self.tail))
+                self.controls = len(self.tail)
+            self.items.appendleft(hello)
+            self.controls += 1
+        self.update()
+
+    def put(self, response):
+        with self.lock:
+            self.record(response)
+            wake = not self.items or self.controls + 1 == self.size
+            if response["type"] == "stream":
+                next = response["data"]["next"]
+                last = self.items[-1] if self.items else None
+                if last and last["type"] == "stream":
+                    last["data"]["next"] += next
+                else:
+                    self.items.append({"type": "stream", "data": {"next": next}})
+                self.text += len(next)
+            else:
+                self.items.append(copy.deepcopy(response))
+                self.controls += 1
+        if wake:
+            try:
+                self.loop.call_soon_threadsafe(self.update)
+            except RuntimeError:
+                pass # loop closed
+
+    def update(self):
+        with self.lock:
+            readable = bool(self.items)
+            writable = self.controls < self.size
+        self.readable.set() if readable else self.readable.clear()
+        self.writable.set() if writable else self.writable.clear()
+
+    def get_nowait(self):
+        with self.lock:
+            response = self.items.popleft() if self.items else None
+            if response and response["type"] == "stream":
+                self.text -= len(response["data"]["next"])
+            elif response:
+                self.controls -= 1
+        self.update()
+        return response
+
+    async def get(self):
+        while True:
+            response = self.get_nowait()
+            if response:
+                return response
+            await self.readable.wait()
+
+    async def drain(self):
+        # stop reading requests from a client that isn't reading its responses
+        await self.writable.wait()
+
+class Session():
+    def __init__(self, key):
+        self.key = key
+        self.master = get_scheme(key)
+        self.scheme = self.master
+        self.features = set()
+        self.method = None
+        self.mirrors = {}
+
+        self.id = None
+        self.name = None
+        self.channel = None
+        self.sender = None
+        self.conn = None
+        self.closing = None
+        self.replaced = False
+
+    def accept(self, hello):
+        # the reply goes out under the master key, everything after under the session key
+        reply = make_hello(f for f in hello["data"].get("features", []) if f in FEATURES)
+        self.features = set(reply["data"]["features"])
+        self.method = get_compression(self.features)
+        self.scheme = get_session_scheme(self.key, bytes(hello["data"]["nonce"]), reply["data"]["nonce"])
+        return reply
+
+    def expand(self, request):
+        # generate requests may carry a delta against a mirrored prompt, None means resync
+        data = request.get("data")
+        if request["type"] != "generate" or "mirror" not in data:
+            return request
+
+        mirror = data.pop("mirror")
+        if "delta" in data:
+            delta = data.pop("delta")
+            old = self.mirrors.get(mirror)
+            prompt = apply_delta(old, delta) if old != None else None
+            if prompt == None:
+                self.mirrors.pop(mirror, None)
+                return None
+            data["prompt"] = prompt
+
+        if mirror in range(MIRROR_COUNT):
+            self.mirrors[mirror] = data["prompt"]
+        return request
+
+    def encrypt(self, obj):
+        start = time.perf_counter()
+        # payloads under the session key carry the compression byte when negotiated
+        if obj["type"] == "hello":
+            data = encrypt(self.master, obj)
+        else:
+            data = encrypt(self.scheme, obj, self.method)
+        metrics.CRYPTO_TIME.inc(time.perf_counter() - start, op="encrypt")
+        metrics.BYTES_SENT.inc(len(data))
+        return data
+
+    def decrypt(self, data):
+        start = time.perf_counter()
+        metrics.BYTES_RECEIVED.inc(len(data))
+        try:
+            return self.decryptScheme(data)
+        finally:
+            metrics.CRYPTO_TIME.inc(time.perf_counter() - start, op="decrypt")
+
+    def decryptScheme(self, data):
+        # requests sent before the client saw our hello still use the master key
+        if self.scheme != self.master:
+            try:
+                return decrypt(self.scheme, data, self.method)
+            except InvalidTag:
+                pass
+        return decrypt(self.master, data)
+
 
 class RemoteServer():
-    def __init__(self, host, port, models_path, key):
+    def __init__(self, host, port, models_path, key, max_models=scheduler.MAX_MODELS, parallel=1, factory=None, worker_count=0):
         self.key = key
         self.models_path = models_path
+        self.host = host
+        self.port = int(port)
         
-        self.inference = None
-        self.server = websockets.sync.server.serve(self.handleConnection, host=host, port=int(port), max_size=None)
+        self.clients = itertools.count()
+        if worker_count > 0:
+            # same interface as the scheduler, but each worker process owns its own models
+            self.scheduler = workers.WorkerPool(models_path, worker_count, max_models, parallel, factory)
+        else:
+            if not factory and parallel > 1:
+                factory = functools.partial(batch.BatchInference, slots=parallel)
+            if factory:
+                self.scheduler = scheduler.Scheduler(models_path, max_models, factory)
+            else:
+                self.scheduler = scheduler.Scheduler(models_path, max_models)
+
+        self.loop = None
+        self.server = None
+        self.closing = None
+        self.detached = {}
+        self.live = {}
+        self.ready = threading.Event()
         self.serve = threading.Thread(target=self.serve_forever, daemon=True)
 
     def start(self):
         print("SERVER: starting")
+        self.scheduler.start()
         self.serve.start()
+        self.ready.wait()
+        if not self.server:
+            raise RuntimeError("failed to start server")
 
     def stop(self):
         print("SERVER: stopping")
-        self.server.shutdown()
+        if self.loop:
+            self.loop.call_soon_threadsafe(self.closing.set)
+        self.scheduler.stop()
         self.join()
         print("SERVER: done")
 
@@ -70,100 +442,217 @@ class RemoteServer():
         return True
 
     def serve_forever(self):
-        self.server.serve_forever()
-            
-    def handleLoop(self, conn):
-        scheme = get_scheme(self.key)
+        try:
+            asyncio.run(self.run())
+        finally:
+            self.ready.set()
 
-        ctr = 0
+    async def run(self):
+        self.loop = asyncio.get_running_loop()
+        self.closing = asyncio.Event()
+        # keepalive pings are handled by websockets, idle connections just wait on recv
+        self.server = await websockets.server.serve(self.handleConnection, host=self.host, port=self.port, max_size=None)
+        self.ready.set()
+        await self.closing.wait()
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def gatherResponses(self, responses, pending, deadline):
+        loop = asyncio.get_running_loop()
+        size = sum(response_size(r) for r in pending)
+        while size < FRAME_SIZE:
+            response = responses.get_nowait()
+            if not response:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    response = await asyncio.wait_for(responses.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            pending += [response]
+            size += response_size(response)
+        return pending
+
+    async def handleResponses(self, conn, session, responses):
+        loop = asyncio.get_running_loop()
+        last = 0
         while True:
-            while self.responses:
-                response = self.responses.pop(0)
+            response = await responses.get()
 
-                data = encrypt(scheme, response)
-                data = [data[i:min(i+FRAGMENT_SIZE,len(data))] for i in range(0, len(data), FRAGMENT_SIZE)]
+            if "frames" in session.features and response["type"] not in {"hello", "resync"}:
+                # the first response after a quiet period goes straight out
+                pending = await self.gatherResponses(responses, [response], last + FRAME_INTERVAL)
+                response = make_frame(pending)
+                last = loop.time()
+
+            data = fragment(session.encrypt(response))
 
-                try:
-                    conn.send(data)
-                except:
-                    return
-            
-            data = None
             try:
-                data = conn.recv(timeout=0)
-            except TimeoutError:
-                pass
+                await conn.send(data)
             except websockets.exceptions.ConnectionClosed:
-                break
-            except Exception as e:
-                print(type(e), e)
-                break
-
-            if not data:
-                time.sleep(0.01)
-                ctr += 1
-                if ctr == 200:
-                    conn.ping()
-                    ctr = 0
-                continue
-
-            error = None
-            request = None
-            if type(data) in {bytes, bytearray}:
-                try:
-                    request = decrypt(scheme, bytes(data))
-                except Exception as e:
-                    error = "incorrect key"
-            else:
-                error = "invalid request"
-            if request:
-                if request["type"] == "abort":
-                    self.inference.abort = True
-                else:
-                    self.requests += [request]
-            else:
-                self.responses += [{"type": "error", "data": {"message": error}}]
-        self.inference.abort = True
-            
-    def makeResponse(self,response):
-        response = copy.deepcopy(response)
-        self.responses += [response]
+                return
 
-    def handleConnection(self, conn):
-        print("SERVER: client connected")
+    def startSender(self, conn, session):
+        if session.sender:
+            session.sender.cancel()
+        session.sender = asyncio.create_task(self.handleResponses(conn, session, session.channel))
 
-        self.responses = []
-        self.requests = []
-        self.inference = inference.Inference(self.models_path, self.makeResponse)
-        thread = threading.Thread(target=self.handleLoop, args=(conn,), daemon=True)
+    def handleHello(self, conn, session, hello):
+        reply = session.accept(hello)
+        reply["data"]["resumed"] = False
 
-        thread.start()
+        name = hello["data"].get("session")
+        if not name or "resume" not in session.features:
+            session.channel.put(reply)
+            return
+        if session.name and self.live.get(session.name) is session:
+            del self.live[session.name]
+        session.name = name
 
-        while True:
-            while not self.requests and thread.is_alive():
-                time.sleep(0.01)
-            if not thread.is_alive():
-                break
-            request = self.requests.pop(0)
-            self.inference.process(request)
+        # the client often notices a drop before the server does, the old connection is still open
+        old = self.live.get(name)
+        self.live[name] = session
+        if old and old is not session:
+            old.replaced = True
+            old.sender.cancel()
+            old.closing = asyncio.create_task(old.conn.close())
+            held = (old.id, old.channel, None)
+        else:
+            held = self.detached.pop(name, None)
+        if not held:
+            session.channel.put(reply)
+            return
+
+        # take over the client the dropped connection left behind
+        id, channel, timer = held
+        if timer:
+            timer.cancel()
+        self.scheduler.disconnect(session.id)
+        print(f"SERVER: client {id} resumed")
+
+        reply["data"]["resumed"] = True
+        session.id, session.channel = id, channel
+        channel.resume(reply, hello["data"].get("resume"))
+        self.startSender(conn, session)
+
+    def detach(self, session):
+        loop = asyncio.get_running_loop()
+        if session.replaced:
+            return
+        if self.live.get(session.name) is session:
+            del self.live[session.name]
+        if not session.name or "resume" not in session.features or self.closing.is_set():
+            self.scheduler.disconnect(session.id)
+            return
+
+        # generations keep running into the channel for a while, in case the client comes back
+        timer = loop.call_later(RESUME_GRACE, self.expire, session.name, session.id)
+        held = self.detached.pop(session.name, None)
+        if held:
+            held[2].cancel()
+            self.scheduler.disconnect(held[0])
+        self.detached[session.name] = (session.id, session.channel, timer)
 
-        print("SERVER: client disconnected")
+    def expire(self, name, id):
+        held = self.detached.get(name)
+        if held and held[0] == id:
+            del self.detached[name]
+            self.scheduler.disconnect(id)
+            print(f"SERVER: client {id} expired")
+
+    async def handleRequests(self, conn, session):
+        try:
+            async for data in conn:
+                if session.replaced:
+                    break
+                responses = session.channel
+                error = None
+                request = None
+                if type(data) in {bytes, bytearray}:
+                    try:
+                        request = session.decrypt(bytes(data))
+                    except Exception as e:
+                        error = "incorrect key"
+                else:
+                    error = "invalid request"
+                if request and request["type"] == "hello":
+                    self.handleHello(conn, session, request)
+                    continue
+                if request:
+                    request = session.expand(request)
+                    if not request:
+                        responses.put({"type": "resync"})
+                        continue
+                    if request["type"] == "generate":
+                        responses.started = time.perf_counter()
+                    # inference runs on the scheduler thread, submitting only queues it
+                    self.scheduler.submit(session.id, request)
+                else:
+                    responses.put({"type": "error", "data": {"message": error}})
+                await responses.drain()
+        except websockets.exceptions.ConnectionClosed:
+            pass
+
+    async def handleConnection(self, conn):
+        loop = asyncio.get_running_loop()
+        session = await loop.run_in_executor(None, Session, self.key)
+
+        session.id = next(self.clients)
+        session.channel = ResponseChannel(loop)
+        session.conn = conn
+        print(f"SERVER: client {session.id} connected")
+
+        self.scheduler.connect(session.id, session.channel)
+        self.startSender(conn, session)
+        metrics.CONNECTIONS.inc()
+        try:
+            await self.handleRequests(conn, session)
+        finally:
+            metrics.CONNECTIONS.dec()
+            session.sender.cancel()
+            self.detach(session)
+
+        if not session.replaced:
+            print(f"SERVER: client {session.id} disconnected")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='lineworks server')
     parser.add_argument('--bind', type=str, help='address (ip:port) to listen on', default="127.0.0.1:29999")
     parser.add_argument('--key', type=str, help='key to derive encryption key from', default=DEFAULT_KEY)
     parser.add_argument('--models', type=str, help='models path', default="models")
+    parser.add_argument('--max-models', type=int, help='models kept loaded at once', default=scheduler.MAX_MODELS)
+    parser.add_argument('--parallel', type=int, help='generations decoded together per model', default=1)
+    parser.add_argument('--workers', type=int, help='inference worker processes, 0 runs inference in the server process', default=0)
+    parser.add_argument('--metrics', type=str, help='address (ip:port) to serve prometheus metrics on', default=None)
+    parser.add_argument('--api', type=str, help='address (ip:port) to serve an openai compatible completions api on', default=None)
     args = parser.parse_args()
 
     ip, port = args.bind.rsplit(":",1)
 
-    server = RemoteServer(ip, port, args.models, args.key)
+    server = RemoteServer(ip, port, args.models, args.key, args.max_models, args.parallel, worker_count=args.workers)
     server.start()
+
+    exporter = None
+    if args.metrics:
+        metrics_ip, metrics_port = args.metrics.rsplit(":",1)
+        exporter = metrics.HTTPServer(metrics_ip, metrics_port)
+        exporter.start()
+
+    api = None
+    if args.api:
+        api_ip, api_port = args.api.rsplit(":",1)
+        key = args.key if args.key != DEFAULT_KEY else None
+        api = metrics.HTTPServer(api_ip, api_port, completions.make_handler(server.scheduler, server.clients, key))
+        api.start()
     
     try:
         while True:
             time.sleep(0.01)
     except KeyboardInterrupt:
         pass
+    if exporter:
+        exporter.stop()
+    if api:
+        api.stop()
     server.stop()
\ No newline at end of file
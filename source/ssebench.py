@@ -0,0 +1,175 @@
+import json
+import zlib
+import time
+import random
+import argparse
+import threading
+import http.server
+
+import sseclient
+
+import api
+
+WORDS = "the a and of to in was she he it said that her his had with for on at but they you not be".split()
+
+def make_openai(rng, count):
+    events = []
+    for i in range(count):
+        event = {
+            "id": "cmpl-8x2kq0a1b2c3d4e5f6g7h8i9",
+            "object": "text_completion",
+            "created": 1700000000,
+            "choices": [{"text": " " + rng.choice(WORDS), "index": 0, "logprobs": None, "finish_reason": None}],
+            "model": "gpt-3.5-turbo-instruct"
+        }
+        events += [b"data: " + json.dumps(event, separators=(",", ":")).encode("utf-8") + b"\n\n"]
+    return b"".join(events) + b"data: [DONE]\n\n"
+
+def make_together(rng, count):
+    events = []
+    for i in range(count):
+        word = " " + rng.choice(WORDS)
+        event = {
+            "choices": [{"text": word}],
+            "id": "8a1b2c3d4e5f6a7b-LAX",
+            "token": {"id": rng.randint(0, 32000), "text": word, "logprob": -rng.random(), "special": False},
+            "generated_text": None,
+            "details": None,
+            "stats": None,
+            "usage": None
+        }
+        events += [b"data: " + json.dumps(event).encode("utf-8") + b"\n\n"]
+    return b"".join(events) + b"data: [DONE]\n\n"
+
+def make_anthropic(rng, count):
+    def event(name, data):
+        return f"event: {name}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n".encode("utf-8")
+    events = [
+        event("message_start", {"type": "message_start", "message": {"id": "msg_01", "type": "message", "role": "assistant", "content": [], "model": "claude-3-opus-20240229", "stop_reason": None, "usage": {"input_tokens": 25, "output_tokens": 1}}}),
+        event("content_block_start", {"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}}),
+        event("ping", {"type": "ping"})
+    ]
+    for i in range(count):
+        events += [event("content_block_delta", {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": " " + rng.choice(WORDS)}})]
+    events += [
+        event("content_block_stop", {"type": "content_block_stop", "index": 0}),
+        event("message_delta", {"type": "message_delta", "delta": {"stop_reason": "end_turn", "stop_sequence": None}, "usage": {"output_tokens": count}}),
+        event("message_stop", {"type": "message_stop"})
+    ]
+    return b"".join(events)
+
+def split(body, size):
+    return [body[i:i+size] for i in range(0, len(body), size)]
+
+def read_sseclient(chunks):
+    # what get_stream did before, kept here to compare against
+    output = []
+    for event in sseclient.SSEClient(iter(chunks)).events():
+        if event.data == "[DONE]":
+            break
+        data = json.loads(event.data)
+        if "choices" in data:
+            output += [data["choices"][0]["text"]]
+        if "type" in data:
+            if data["type"] == "message_stop":
+                break
+            if data["type"] == "content_block_delta":
+                output += [data["delta"]["text"]]
+    return output
+
+def read_incremental(chunks):
+    output = []
+    for data in api.iter_events(iter(chunks)):
+        text, finished = api.get_text(data)
+        if finished:
+            break
+        if text != None:
+            output += [text]
+    return output
+
+class StreamHandler(http.server.BaseHTTPRequestHandler):
+    # serves one body as a chunked event stream, gzip encoded when asked, flushed per event
+    protocol_version = "HTTP/1.1"
+    body = b""
+    encoding = None
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        if self.encoding:
+            self.send_header("Content-Encoding", self.encoding)
+        self.end_headers()
+
+        compressor = zlib.compressobj(wbits=31) if self.encoding == "gzip" else None
+        for event in self.body.split(b"\n\n"):
+            if not event:
+                continue
+            data = event + b"\n\n"
+            if compressor:
+                data = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        if compressor:
+            data = compressor.flush()
+            self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.write(b"0\r\n\r\n")
+
+    def log_message(self, format, *args):
+        pass
+
+def read_http(body, encoding):
+    handler = type("Handler", (StreamHandler,), {"body": body, "encoding": encoding})
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        endpoint = f"http://127.0.0.1:{server.server_address[1]}/"
+        parameters = {"prompt": "", "model": "m", "max_tokens": 1, "temperature": 1.0, "top_p": 1.0, "top_k": 0, "repeat_penalty": 1.0}
+        return list(api.get_stream(endpoint, "", parameters, api.make_session()))
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def measure(read, chunks, repeats):
+    best = None
+    for i in range(repeats):
+        start = time.perf_counter()
+        output = read(chunks)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best == None else min(best, elapsed)
+    return best, output
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='compare the incremental sse reader against sseclient')
+    parser.add_argument('--record', type=str, action='append', help='raw response body captured from a provider (e.g. curl -N), can be repeated', default=[])
+    parser.add_argument('--events', type=int, help='events in each generated stream', default=2000)
+    parser.add_argument('--chunk', type=int, help='bytes per network read', default=1024)
+    parser.add_argument('--repeats', type=int, help='runs per reader, the best is kept', default=5)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    streams = []
+    for path in args.record:
+        with open(path, "rb") as f:
+            streams += [(path, f.read())]
+    if not streams:
+        streams = [
+            ("openai", make_openai(rng, args.events)),
+            ("together", make_together(rng, args.events)),
+            ("anthropic", make_anthropic(rng, args.events))
+        ]
+
+    for name, body in streams:
+        expected = read_sseclient(split(body, args.chunk))
+        for encoding in [None, "gzip"]:
+            if read_http(body, encoding) != expected:
+                print(f"{name}: outputs differ over http with {encoding or 'identity'} encoding")
+
+    for name, body in streams:
+        chunks = split(body, args.chunk)
+        old, expected = measure(read_sseclient, chunks, args.repeats)
+        new, output = measure(read_incremental, chunks, args.repeats)
+        if output != expected:
+            print(f"{name}: outputs differ, {len(output)} texts against {len(expected)}")
+            continue
+        print(f"{name+':':<11} {len(output)} texts, sseclient {len(output) / old:,.0f}/s, incremental {len(output) / new:,.0f}/s, {old / new:.1f}x")
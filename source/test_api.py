@@ -0,0 +1,10 @@
+import random
+
+import ssebench
+
+def test_stream_encodings():
+    rng = random.Random(0)
+    for body in [ssebench.make_openai(rng, 50), ssebench.make_together(rng, 50), ssebench.make_anthropic(rng, 50)]:
+        expected = ssebench.read_sseclient(ssebench.split(body, 1024))
+        assert ssebench.read_http(body, None) == expected
+        assert ssebench.read_http(body, "gzip") == expected
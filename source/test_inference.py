@@ -0,0 +1,189 @@
+import re
+import random
+
+import inference
+
+PARAGRAPH_MATCH = re.compile(r"(.+\n[\s\n]*\n)", flags=re.UNICODE)
+LINE_MATCH = re.compile(r"(.+\n)", flags=re.UNICODE)
+CONDITIONS = ["None", "Sentence", "Paragraph", "Line"]
+
+def split_sentences_old(text):
+    # the original O(n^2) splitter, frozen to check the replacements against
+    def get(i):
+        if i < len(text):
+            return f"{text[i]}"
+        return None
+    
+    sentences = []
+    sentence = ""
+    end = False
+    alpha = False
+    while text:
+        if end:
+            end = False
+            alpha = False
+            sentences += [sentence]
+            sentence = ""
+        
+        a, b, c = get(0), get(1), get(2)
+
+        if a.isalpha():
+            alpha = True
+
+        if a in '.!?' and (b and b in '"') and alpha:
+            sentence += a + b
+            text = text[2:]
+            end = True
+            continue
+        
+        if a in '.!?…' and ((b and b in ' ') or not b) and alpha:
+            sentence += a
+            text = text[1:]
+            end = True
+            continue
+
+        if not a in '\n' and (b and b in '\n') and alpha:
+            sentence += a + b
+            text = text[1:]
+            end = True
+            continue
+            
+        sentence += a
+        text = text[1:]
+
+    if end:
+        sentences += [sentence]
+        sentence = ""
+
+    return sentence, sentences
+
+def stop_old(condition, prompt, chunks):
+    # the original per-token loop, rescanning everything generated so far
+    stop_context = ""
+    if condition == "Sentence":
+        sentence, _ = split_sentences_old(prompt)
+        stop_context = sentence.lstrip()
+
+    output = ""
+    streamed = []
+    stopping = False
+    for next in chunks:
+        if condition == "Sentence":
+            tmp = stop_context + output + next
+
+            sentence, sentences = split_sentences_old(tmp)
+            sentences += [sentence]
+
+            if len(sentences) > 1:
+                sentence = sentences[0]
+                next_tmp = sentence[len(stop_context + output):]
+                output_tmp = sentence[len(stop_context):]
+                if not output_tmp.strip():
+                    stop_context = ""
+                    output += next
+                else:
+                    next = next_tmp
+                    output = output_tmp
+                    stopping = True
+            else:
+                output += next
+        elif condition in {"Paragraph", "Line"}:
+            tmp = output + next
+            match = (PARAGRAPH_MATCH if condition == "Paragraph" else LINE_MATCH).search(tmp)
+            if match:
+                paragraph = tmp[:match.end()]
+                next = paragraph[len(output):]
+                output = paragraph
+                stopping = True
+            else:
+                output += next
+        else:
+            output += next
+
+        streamed += [next]
+        if stopping:
+            break
+    return streamed, stopping, output
+
+def stop_new(condition, prompt, chunks):
+    stopper = inference.StopCondition(condition, prompt)
+    streamed = []
+    stopping = False
+    for next in chunks:
+        next, stopping = stopper.feed(next)
+        streamed += [next]
+        if stopping:
+            break
+    return streamed, stopping, stopper.output
+
+CASES = [
+    "",
+    "a",
+    ".",
+    "Hello.",
+    "Hello. World",
+    "Hello world. ",
+    '"Stop." She left.',
+    '"Stop!" she said. "Now?"',
+    'He said "no."',
+    '."',
+    'a."',
+    'a."b',
+    "Wait…",
+    "Wait… then",
+    "Wait…then",
+    "…",
+    "a\n",
+    "a\nb",
+    "a\n\nb",
+    "\n\na",
+    "line one\nline two\n",
+    "a.\nb",
+    "a!\n\"b\"",
+    "A. B. C.",
+    "...",
+    "1. 2. 3.",
+    "x.. y",
+    "x?! y",
+    "é. ü? ß!",
+    "日本語。 テスト.",
+    "  spaced  . out ",
+]
+
+def check(text):
+    expected = split_sentences_old(text)
+    assert inference.split_sentences(text) == expected, repr(text)
+    assert inference.trailing_sentence(text) == expected[0], repr(text)
+
+def test_cases():
+    for text in CASES:
+        check(text)
+
+def test_random():
+    rng = random.Random(0)
+    alphabet = ['a', 'b', 'Z', 'é', '1', ' ', ' ', '.', '!', '?', '…', '"', '\n', '\n', ',']
+    for i in range(20000):
+        check("".join(rng.choice(alphabet) for _ in range(rng.randint(0, 40))))
+
+def test_prose():
+    rng = random.Random(1)
+    words = ["she", "said", "Hello.", "\"Wait!\"", "no…", "line\n", "\n\n", "why?", "end.\"", "ok"]
+    for i in range(2000):
+        check(" ".join(rng.choice(words) for _ in range(rng.randint(0, 60))))
+
+def split_chunks(rng, text):
+    chunks = []
+    while text:
+        size = rng.choice([0, 1, 1, 2, 3, 5, 8])
+        chunks += [text[:size]]
+        text = text[size:]
+    return chunks
+
+def test_stop_condition():
+    rng = random.Random(2)
+    alphabet = ['a', 'b', 'Z', 'é', ' ', ' ', '.', '!', '?', '…', '"', '\n', '\n', '\t', ',']
+    for i in range(20000):
+        prompt = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 20)))
+        chunks = split_chunks(rng, "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 60))))
+        for condition in CONDITIONS:
+            assert stop_new(condition, prompt, chunks) == stop_old(condition, prompt, chunks), repr((condition, prompt, chunks))
@@ -0,0 +1,293 @@
+import json
+import time
+import threading
+import collections
+import functools
+import multiprocessing
+import multiprocessing.connection
+
+import scheduler
+import batch
+import metrics
+
+STOP_TIMEOUT = 5
+METRICS_INTERVAL = 1
+
+# computed by the pool from what it routes, the per-worker copies are not forwarded
+ROUTED_METRICS = {"lineworks_queue_depth", "lineworks_active_generations"}
+
+# which routed requests a response can finish
+FINISHES = {
+    "done": {"load", "unload", "generate"},
+    "aborted": {"generate"},
+    "error": {"load", "unload", "generate", "options"},
+    "options": {"options"}
+}
+
+def report_metrics(send):
+    while True:
+        time.sleep(METRICS_INTERVAL)
+        send((None, {"type": "metrics", "data": metrics.REGISTRY.snapshot(ROUTED_METRICS)}))
+
+def worker_main(conn, models_path, max_models, parallel, factory):
+    # runs in the worker process, a plain Scheduler fed over the pipe
+    lock = threading.Lock()
+    def send(message):
+        with lock:
+            try:
+                conn.send(message)
+            except (OSError, EOFError):
+                pass
+
+    if not factory and parallel > 1:
+        factory = functools.partial(batch.BatchInference, slots=parallel)
+    if factory:
+        local = scheduler.Scheduler(models_path, max_models, factory)
+    else:
+        local = scheduler.Scheduler(models_path, max_models)
+    local.start()
+    threading.Thread(target=report_metrics, args=(send,), daemon=True).start()
+
+    while True:
+        try:
+            message = conn.recv()
+        except (OSError, EOFError):
+            break
+        typ, id = message[0], message[1]
+        if typ == "connect":
+            local.connect(id, lambda response, id=id: send((id, response)))
+        elif typ == "disconnect":
+            local.disconnect(id)
+        elif typ == "submit":
+            local.submit(id, message[2])
+        elif typ == "stop":
+            break
+    local.stop()
+
+class Worker():
+    def __init__(self, index):
+        self.index = index
+        self.process = None
+        self.conn = None
+        self.lock = threading.Lock()
+        self.clients = set()
+        self.models = []
+        self.samples = []
+
+class RouterClient():
+    def __init__(self, id, respond):
+        self.id = id
+        self.respond = respond
+        self.worker = None
+        self.reset()
+
+    def reset(self):
+        # routed requests that have not finished yet, as (type, model key)
+        self.pending = collections.deque()
+        self.started = False
+        self.evicted = False
+
+class WorkerPool():
+    # same interface as Scheduler, each client sticks to the worker it was first routed to
+    def __init__(self, models_path, workers, max_models=scheduler.MAX_MODELS, parallel=1, factory=None):
+        self.models_path = models_path
+        self.max_models = max(max_models, 1)
+        self.parallel = parallel
+        self.factory = factory
+
+        self.context = multiprocessing.get_context("spawn")
+        self.workers = [Worker(i) for i in range(max(workers, 1))]
+        self.clients = {}
+        self.lock = threading.Lock()
+        self.stopping = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+        self.restarts = metrics.REGISTRY.counter("lineworks_worker_restarts_total", "Worker processes restarted after crashing.")
+        metrics.REGISTRY.gauge("lineworks_worker_clients", "Clients routed to each worker.", self.getClients)
+        metrics.REGISTRY.gauge("lineworks_queue_depth", "Requests waiting per client.", self.getDepths)
+        metrics.REGISTRY.gauge("lineworks_active_generations", "Generations currently running.", self.getActive)
+        metrics.REGISTRY.forward(self.getSamples)
+
+    def getClients(self):
+        with self.lock:
+            return [({"worker": w.index}, len(w.clients)) for w in self.workers]
+
+    def getDepths(self):
+        with self.lock:
+            return [({"client": id}, len(c.pending) - c.started) for id, c in self.clients.items()]
+
+    def getActive(self):
+        with self.lock:
+            return sum(1 for c in self.clients.values() if c.started and c.pending and c.pending[0][0] == "generate")
+
+    def getSamples(self):
+        with self.lock:
+            return [({"worker": w.index}, w.samples) for w in self.workers]
+
+    def spawn(self, worker):
+        parent, child = self.context.Pipe()
+        worker.process = self.context.Process(
+            target=worker_main,
+            args=(child, self.models_path, self.max_models, self.parallel, self.factory),
+            daemon=True
+        )
+        worker.process.start()
+        child.close()
+        worker.conn = parent
+
+    def send(self, worker, message):
+        with worker.lock:
+            if not worker.conn:
+                return False
+            try:
+                worker.conn.send(message)
+                return True
+            except (OSError, EOFError):
+                return False
+
+    def start(self):
+        for worker in self.workers:
+            self.spawn(worker)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping = True
+        for worker in self.workers:
+            self.send(worker, ("stop", None))
+        for worker in self.workers:
+            if worker.process:
+                worker.process.join(STOP_TIMEOUT)
+                if worker.process.is_alive():
+                    worker.process.terminate()
+
+    def connect(self, id, respond):
+        with self.lock:
+            self.clients[id] = RouterClient(id, respond)
+
+    def disconnect(self, id):
+        with self.lock:
+            client = self.clients.pop(id, None)
+            worker = client.worker if client else None
+            if worker:
+                worker.clients.discard(id)
+                self.send(worker, ("disconnect", id))
+
+    def assign(self, request):
+        # a worker that already has the model warm wins, otherwise the least busy one
+        alive = [w for w in self.workers if w.conn] or self.workers
+        if request["type"] == "load":
+            key = scheduler.model_key(request["data"])
+            warm = [w for w in alive if key in w.models]
+            if warm:
+                return min(warm, key=lambda w: len(w.clients))
+        return min(alive, key=lambda w: len(w.clients))
+
+    def getModels(self):
+        models = [json.loads(key) for w in self.workers for key in reversed(w.models)]
+        capacity = sum(self.max_models - len(w.models) for w in self.workers)
+        return {"type": "models", "data": {"models": models, "capacity": capacity}}
+
+    def submit(self, id, request):
+        with self.lock:
+            client = self.clients.get(id)
+            if not client:
+                return
+            if request["type"] == "models":
+                client.respond(self.getModels())
+                return
+            if not client.worker:
+                if request["type"] == "abort":
+                    return
+                client.worker = self.assign(request)
+                client.worker.clients.add(id)
+                self.send(client.worker, ("connect", id))
+
+            worker = client.worker
+            if request["type"] != "abort":
+                key = scheduler.model_key(request["data"]) if request["type"] == "load" else None
+                client.pending.append((request["type"], key))
+            self.send(worker, ("submit", id, request))
+
+    def route(self, worker, client, response):
+        typ = response["type"]
+        head = client.pending[0][0] if client.pending else None
+        if typ == "status":
+            # an unload the client never asked for, another client's load evicted its model
+            if response["data"]["message"] == "unloading" and head != "unload":
+                client.evicted = True
+            elif head:
+                client.started = True
+            return
+        if typ == "done" and client.evicted:
+            client.evicted = False
+            return
+
+        finishes = FINISHES.get(typ, set())
+        # an abort ends the queued generations first, the running one last
+        entries = list(reversed(client.pending)) if typ == "aborted" else list(client.pending)
+        entry = next((e for e in entries if e[0] in finishes), None)
+        if not entry:
+            return
+        if entry is client.pending[0]:
+            client.started = False
+        client.pending.remove(entry)
+
+        # only counted as warm once the worker reports the load done
+        if entry[0] == "load" and typ == "done":
+            if entry[1] in worker.models:
+                worker.models.remove(entry[1])
+            worker.models = (worker.models + [entry[1]])[-self.max_models:]
+
+    def crashed(self, worker):
+        with self.lock:
+            if worker.conn:
+                worker.conn.close()
+                worker.conn = None
+            clients = [self.clients[id] for id in worker.clients if id in self.clients]
+            for client in clients:
+                client.worker = None
+                client.reset()
+            worker.clients = set()
+            worker.models = []
+            worker.samples = []
+            if self.stopping:
+                return
+
+        print(f"SERVER: worker {worker.index} crashed, restarting")
+        self.restarts.inc()
+
+        # the model went with the process, tell the clients it is gone
+        for client in clients:
+            client.respond({"type": "error", "data": {"message": "worker crashed"}})
+            client.respond({"type": "status", "data": {"message": "unloading"}})
+            client.respond({"type": "done"})
+
+        # reap the dead process before replacing it
+        worker.process.join(STOP_TIMEOUT)
+        if worker.process.is_alive():
+            worker.process.terminate()
+            worker.process.join()
+        self.spawn(worker)
+
+    def run(self):
+        while not self.stopping:
+            conns = {w.conn: w for w in self.workers if w.conn}
+            for conn in multiprocessing.connection.wait(list(conns), timeout=0.5):
+                worker = conns[conn]
+                try:
+                    id, response = conn.recv()
+                except (OSError, EOFError):
+                    self.crashed(worker)
+                    continue
+
+                if id == None and response["type"] == "metrics":
+                    with self.lock:
+                        worker.samples = response["data"]
+                    continue
+
+                with self.lock:
+                    client = self.clients.get(id)
+                    if client and client.worker == worker:
+                        self.route(worker, client, response)
+                if client and client.worker == worker:
+                    client.respond(response)